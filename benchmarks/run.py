@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Time each stage of the load -> join -> plot pipeline on synthetic data.
+
+Example:
+
+    python benchmarks/run.py --scales 1e3 1e4 1e5 --output bench.json
+    python benchmarks/run.py --scales 1e3 1e4 1e5 --compare bench.json
+
+Results are written as JSON, and --compare prints the ratio of each
+stage's time to the same stage in an earlier results file.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import synthetic
+
+def timed(results, rows, stage, func, repeat=1):
+    # Keep the fastest of repeat runs, which is the least noisy estimate
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results.append({"rows": rows, "stage": stage, "seconds": best})
+    print("{:>10} {:<28} {:10.4f} s".format(rows, stage, best))
+    return value
+
+def time_tower_list(results, rows, dataset, reference_file):
+    import walksignal.towers as towers
+    marks = [("tower ids", time.perf_counter())]
+    tower_list = towers.TowerList(dataset, reference_file, progress=lambda stage: marks.append((stage, time.perf_counter())))
+    marks.append(("end", time.perf_counter()))
+    names = {"tower ids": "get_tower_ids", "reference": "load_reference", "towers": "get_towers",
+             "data points": "get_tower_data_points", "distances": "get_distances"}
+    for (stage, start), (_, stop) in zip(marks[:-1], marks[1:]):
+        results.append({"rows": rows, "stage": "towers." + names[stage], "seconds": stop - start})
+        print("{:>10} {:<28} {:10.4f} s".format(rows, "towers." + names[stage], stop - start))
+    return tower_list
+
+def time_live_update(results, rows, measurements, reference_file):
+    # Load the first half of the measurements as a live file, minus the
+    # rows of a few cells so that the update has to add new towers, then
+    # append the rest and check the updated towers against a full build
+    import walksignal.data as data
+    import walksignal.towers as towers
+    with open(measurements) as f:
+        header, *lines = f.readlines()
+    held_back = {line.split(",")[3] for line in lines[:5]}
+    first = [line for line in lines[:len(lines) // 2] if line.split(",")[3] not in held_back]
+    rest = [line for line in lines[:len(lines) // 2] if line.split(",")[3] in held_back] + lines[len(lines) // 2:]
+    live_file = os.path.join(os.path.dirname(measurements), "live.csv")
+    with open(live_file, "w") as f:
+        f.write(header)
+        f.writelines(first)
+    dataset = data.LiveDataSet(live_file)
+    tower_list = towers.TowerList(dataset, reference_file)
+    with open(live_file, "a") as f:
+        f.writelines(rest)
+    dataset.refresh()
+    timed(results, rows, "towers.update", tower_list.update)
+
+    full = towers.TowerList(data.DataSet(live_file, use_cache=False), reference_file)
+    if sorted(tower_list.tower_index) != sorted(full.tower_index):
+        raise ValueError("Live update found different towers than a full build")
+    for key, expected in full.tower_index.items():
+        tower = tower_list.tower_index[key]
+        for name, column in expected.columns.items():
+            if tower.columns[name].dtype != column.dtype or not np.array_equal(tower.columns[name], column):
+                raise ValueError("Live update of tower {0} doesn't match a full build in {1}".format(key, name))
+        if not np.allclose(tower.distances, expected.distances):
+            raise ValueError("Live update of tower {0} doesn't match a full build in distances".format(key))
+
+def benchmark_scale(results, rows, reference_rows, directory, repeat):
+    import walksignal.data as data
+    import walksignal.equations as equations
+    import walksignal.plottools as plottools
+    import walksignal.reference as reference_index
+    import walksignal.utils as utils
+
+    measurements, reference = timed(results, rows, "generate", lambda: synthetic.make_dataset(directory, rows, reference_rows))
+
+    timed(results, rows, "dataset.parse", lambda: data.DataSet(measurements, use_cache=False), repeat)
+    dataset = timed(results, rows, "dataset.cache_write", lambda: data.DataSet(measurements))
+    dataset = timed(results, rows, "dataset.cache_load", lambda: data.DataSet(measurements), repeat)
+
+    timed(results, rows, "reference.build_index", lambda: reference_index.build_index(reference))
+    time_tower_list(results, rows, dataset, reference)
+    time_live_update(results, rows, measurements, reference)
+
+    x_range = np.linspace(1, 500, 250)
+    timed(results, rows, "equations.rwm_2d", lambda: equations.gplt_rwm_fpd2d(0.5, 0.5, x_range), repeat)
+    timed(results, rows, "equations.rwm_3d", lambda: equations.gplt_rwm_fpd3d(0.5, 0.5, x_range), repeat)
+    grid_dens, grid_abs = np.meshgrid(np.linspace(0.01, 1, 100), np.linspace(0.01, 0.99, 99))
+    timed(results, rows, "equations.rwm_grid_3d", lambda: equations.rwm_grid("3d", grid_dens, grid_abs, x_range), repeat)
+
+    timed(results, rows, "plot.correct_positions", lambda: utils.correct_positions(dataset.lat, dataset.lon, dataset.speed_values, dataset.direction), repeat)
+    timed(results, rows, "plot.plot_data", lambda: plottools.PlotData(measurements, reference, figure=False), repeat)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(entry["rows"], entry["stage"]): entry["seconds"] for entry in json.load(f)["results"]}
+    print("\n{:>10} {:<28} {:>10} {:>10} {:>7}".format("rows", "stage", "before", "after", "ratio"))
+    for entry in results:
+        before = baseline.get((entry["rows"], entry["stage"]))
+        if before:
+            print("{:>10} {:<28} {:10.4f} {:10.4f} {:7.2f}".format(entry["rows"], entry["stage"], before, entry["seconds"], entry["seconds"] / before))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", type=float, default=[1e3, 1e4, 1e5], help="numbers of measurement rows, up to 1e7")
+    parser.add_argument("--reference-rows", type=float, default=1e5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="where to write the synthetic data (default: a temporary directory)")
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    results = []
+    start = time.perf_counter()
+    import walksignal
+    results.append({"rows": 0, "stage": "import", "seconds": time.perf_counter() - start})
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            directory = os.path.join(args.workdir or tmp, "synthetic_{0}".format(int(scale)))
+            benchmark_scale(results, int(scale), int(args.reference_rows), directory, args.repeat)
+
+    report = {"commit": git_commit(), "python": platform.python_version(), "numpy": np.__version__,
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,101 @@
+"""Generate synthetic OpenCellID measurement and reference files.
+
+The measurements follow a random walk inside a bounding box near Ottawa,
+with every sample attached to one of a fixed set of towers, and are
+written in the Network Cell Info Lite export format along with a map.png
+and bbox.txt, so the result can be loaded like the datasets in data/.
+"""
+import os
+import numpy as np
+
+BBOX = (-75.7104, -75.6856, 45.4072, 45.4218)
+HEADER = "mcc,mnc,lac,cellid,lat,lon,signal,measured_at,rating,speed,direction,act,ta,psc,tac,pci,sid,nid,bid\n"
+REFERENCE_HEADER = "radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal\n"
+ACCESS_TYPES = np.array(["LTE", "LTE+", "UMTS", "HSPA+"])
+
+# Rows are generated and written in chunks, so memory use doesn't depend
+# on the size of the file
+CHUNK_ROWS = 100000
+
+def make_towers(count, seed=0):
+    rng = np.random.default_rng(seed)
+    lon_min, lon_max, lat_min, lat_max = BBOX
+    return {
+        "mcc": np.full(count, 302),
+        "mnc": rng.choice([220, 610, 720], count),
+        "lac": rng.integers(1, 65535, count),
+        "cellid": rng.choice(2 ** 28 - 1, count, replace=False) + 1,
+        "lat": rng.uniform(lat_min, lat_max, count),
+        "lon": rng.uniform(lon_min, lon_max, count),
+        "range": rng.integers(200, 3000, count),
+    }
+
+def write_measurements(path, rows, towers, seed=0):
+    rng = np.random.default_rng(seed)
+    lon_min, lon_max, lat_min, lat_max = BBOX
+    lat, lon = (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+    time = 1610209931784
+    with open(path, "w") as f:
+        f.write(HEADER)
+        for start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - start)
+            lats = np.clip(lat + np.cumsum(rng.normal(0, 2e-5, n)), lat_min, lat_max)
+            lons = np.clip(lon + np.cumsum(rng.normal(0, 2e-5, n)), lon_min, lon_max)
+            lat, lon = lats[-1], lons[-1]
+            times = time + np.cumsum(rng.integers(1000, 10000, n))
+            time = times[-1]
+            cells = rng.integers(0, len(towers["cellid"]), n)
+            signal = rng.integers(-120, -50, n)
+            rating = np.round(rng.uniform(3, 150, n), 1)
+            speed = rng.uniform(0, 5, n)
+            direction = rng.uniform(0, 360, n)
+            act = ACCESS_TYPES[rng.integers(0, len(ACCESS_TYPES), n)]
+            ta = rng.integers(0, 20, n)
+            pci = rng.integers(0, 504, n)
+            lines = ["{0},{1},{2},{3},{4:.7f},{5:.7f},{6},{7},{8},{9:.7f},{10:.5f},{11},{12},,{2},{13},,,\n".format(
+                        towers["mcc"][c], towers["mnc"][c], towers["lac"][c], towers["cellid"][c], lats[i], lons[i],
+                        signal[i], times[i], rating[i], speed[i], direction[i], act[i], ta[i], pci[i])
+                     for i, c in enumerate(cells.tolist())]
+            f.writelines(lines)
+
+def write_reference(path, rows, towers, seed=0):
+    """Write a reference file with rows lines, including every tower in
+    towers, padded with random cells that are never measured."""
+    rng = np.random.default_rng(seed + 1)
+    count = len(towers["cellid"])
+    # The real towers are spread evenly through the padding, as they
+    # would be in a country-wide dump
+    positions = set(np.linspace(0, rows - 1, count).astype(int).tolist()) if rows > count else set(range(count))
+    tower_rows = iter(range(count))
+    with open(path, "w") as f:
+        f.write(REFERENCE_HEADER)
+        for start in range(0, max(rows, count), CHUNK_ROWS):
+            lines = []
+            for i in range(start, min(start + CHUNK_ROWS, max(rows, count))):
+                if i in positions:
+                    t = next(tower_rows)
+                    lines.append("LTE,{0},{1},{2},{3},,{4:.7f},{5:.7f},{6},12,1,1,1,0\n".format(
+                        towers["mcc"][t], towers["mnc"][t], towers["lac"][t], towers["cellid"][t], towers["lon"][t], towers["lat"][t], towers["range"][t]))
+                else:
+                    lines.append("LTE,302,{0},{1},{2},,{3:.6f},{4:.6f},1000,5,1,1,1,0\n".format(
+                        rng.integers(1, 999), rng.integers(1, 65535), rng.integers(2 ** 28, 2 ** 32), rng.uniform(-141, -52), rng.uniform(42, 83)))
+            f.writelines(lines)
+
+def write_map(directory):
+    import matplotlib.image
+    image = np.full((200, 300, 3), 0.9)
+    matplotlib.image.imsave(os.path.join(directory, "map.png"), image)
+    with open(os.path.join(directory, "bbox.txt"), "w") as f:
+        f.write(", ".join(str(value) for value in BBOX) + "\n")
+
+def make_dataset(directory, rows, reference_rows, tower_count=200, seed=0):
+    """Write measurements.csv, reference.csv, map.png and bbox.txt to
+    directory, and return the paths of the two CSV files."""
+    os.makedirs(directory, exist_ok=True)
+    towers = make_towers(tower_count, seed)
+    measurements = os.path.join(directory, "measurements.csv")
+    reference = os.path.join(directory, "reference.csv")
+    write_measurements(measurements, rows, towers, seed)
+    write_reference(reference, reference_rows, towers, seed)
+    write_map(directory)
+    return measurements, reference
@@ -1,4 +1,32 @@
-from .data import *
-from .plottools import *
-from .towers import *
-from .utils import *
+import importlib
+
+# Submodules are only imported when first used, so that e.g. reading a
+# dataset doesn't pull in matplotlib or scipy
+_SUBMODULES = ["cache", "data", "equations", "fitting", "groom", "plottools", "profiling", "reference", "render", "spatial", "store", "towers", "utils"]
+
+# Names that can be used directly from the package, and their submodules
+_EXPORTS = {
+    "data": ["DataSet", "MultiDataSet", "LiveDataSet", "ColumnBuffer", "load_dataset", "load_columns", "parse_columns", "parse_lines", "access_type_code"],
+    "groom": ["groom_files"],
+    "store": ["Store", "StoreDataSet"],
+    "plottools": ["PlotData", "plot_rating", "plot_data", "plot_positioning", "plot_gsp", "plot_towerdata", "fit_all_towers",
+                  "plt_set_label", "plt_set_colorbar", "plt_set_bbox", "plt_signal_scatter", "plt_points_scatter",
+                  "plt_rwm_fpd2d", "plt_rwm_fpd3d", "gplt_rwm_fpd2d", "gplt_rwm_fpd3d",
+                  "plt_signal_layer", "SignalRaster"],
+    "towers": ["Tower", "TowerList", "TowerDataPoint", "PowerProfile"],
+    "utils": ["read_csv", "read_typed_csv", "get_bbox", "convert_to_xy", "convert_to_latlon", "advance_coordinates",
+              "project_next_position", "project_next_positions", "latlon_to_zone_numbers", "correct_positions",
+              "get_distance", "get_distances", "parse_typed_lines", "bin_values"],
+}
+_EXPORT_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+__all__ = sorted(_EXPORT_MODULES)
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    if name in _EXPORT_MODULES:
+        return getattr(importlib.import_module("." + _EXPORT_MODULES[name], __name__), name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_EXPORT_MODULES))
@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+
+# Bump this whenever the set or meaning of cached columns changes so that
+# stale caches are rebuilt instead of loaded
+CACHE_VERSION = 2
+
+def cache_path(source):
+    return source + ".cache"
+
+def source_stamp(source):
+    stat = os.stat(source)
+    return {"path": os.path.abspath(source), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "version": CACHE_VERSION}
+
+def writable(source):
+    # Whether the cache for source can be created or updated
+    path = cache_path(source)
+    if os.path.isdir(path):
+        return os.access(path, os.W_OK)
+    return os.access(os.path.dirname(os.path.abspath(path)), os.W_OK)
+
+def load_columns(source, names):
+    """Return a dict of memory-mapped column arrays cached for source.
+
+    None is returned if there is no cache, if it is missing any of the
+    requested columns, or if it was written for a different version of
+    the source file (as determined by its path, size and mtime).
+    """
+    path = cache_path(source)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["source"] != source_stamp(source) or not set(names) <= set(meta["columns"]):
+            return None
+        return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in names}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_columns(source, columns):
+    """Write each array in columns to a .npy file in the cache for source.
+
+    The metadata file is written last so that an interrupted write leaves
+    behind a cache that load_columns ignores. Returns False if the cache
+    could not be written, for example because the data directory is
+    read-only.
+    """
+    path = cache_path(source)
+    meta_file = os.path.join(path, "meta.json")
+    try:
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        for name, column in columns.items():
+            np.save(os.path.join(path, name + ".npy"), np.asarray(column), allow_pickle=False)
+        with open(meta_file, "w") as f:
+            json.dump({"source": source_stamp(source), "columns": sorted(columns)}, f)
+    except OSError:
+        return False
+    return True
+
+class ColumnWriter:
+    """Write the cache for source a chunk of rows at a time.
+
+    Each column is appended to its .npy file as rows arrive, so only the
+    current chunk is ever in memory, and the row count in the .npy headers
+    is filled in by close(). As with save_columns, the metadata file is
+    written last, so close() must be called after source itself has been
+    completely written.
+    """
+    def __init__(self, source, dtypes):
+        self.source = source
+        self.path = cache_path(source)
+        self.meta_file = os.path.join(self.path, "meta.json")
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.rows = 0
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.meta_file):
+            os.remove(self.meta_file)
+        self.files = {}
+        for name in self.dtypes:
+            self.files[name] = open(os.path.join(self.path, name + ".npy"), "wb")
+            self.write_header(name)
+
+    def write_header(self, name):
+        # numpy pads the header so that its size doesn't change with the
+        # length of the array, which lets it be rewritten in place
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtypes[name]), "fortran_order": False, "shape": (self.rows,)}
+        np.lib.format.write_array_header_1_0(self.files[name], header)
+
+    def append(self, columns):
+        for name, column_file in self.files.items():
+            column_file.write(np.ascontiguousarray(columns[name], dtype=self.dtypes[name]).tobytes())
+        self.rows += len(columns[next(iter(self.files))])
+
+    def close(self):
+        for name, column_file in self.files.items():
+            column_file.seek(0)
+            self.write_header(name)
+            column_file.close()
+        with open(self.meta_file, "w") as f:
+            json.dump({"source": source_stamp(self.source), "columns": sorted(self.dtypes)}, f)
@@ -1,62 +1,98 @@
 #!/usr/bin/python3 
 import csv
+import multiprocessing
 import sys
 import numpy as np
 import time
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+import walksignal.cache as cache
+import walksignal.profiling as profiling
 import walksignal.utils as utils
 
+# Header of the OpenCellID export format written by Network Cell Info Lite
+EXPORT_COLUMNS = ["mcc", "mnc", "lac", "cellid", "lat", "lon", "signal", "measured_at", "rating", "speed", "direction", "act", "ta", "psc", "tac", "pci", "sid", "nid", "bid"]
+
+# Columns of the OpenCellID export format that walksignal uses, as
+# (CSV column, DataSet attribute, type). psc, sid, nid and bid are never
+# read.
+SCHEMA = [
+    ("mcc", "mcc", np.int64),
+    ("mnc", "mnc", np.int64),
+    ("lac", "lac", np.int64),
+    ("cellid", "cellid", np.int64),
+    ("lat", "lat", np.float64),
+    ("lon", "lon", np.float64),
+    ("signal", "signal_range", np.float64),
+    ("measured_at", "time_range", np.float64),
+    ("rating", "rating", np.float64),
+    ("speed", "speed_values", np.float64),
+    ("direction", "direction", np.float64),
+    ("act", "access_type", np.int8),
+    ("ta", "timing_advance", np.float64),
+    ("tac", "tac", np.int64),
+    ("pci", "pcis", np.float64),
+]
+
+# Access types are stored as indices into ACCESS_TYPES, with anything not
+# listed here stored as 0
+ACCESS_TYPES = np.array(["other", "LTE", "LTE+", "UMTS", "HSPA+", "HSPA", "HSDPA", "HSUPA", "EDGE", "GPRS", "GSM", "CDMA", "NR"])
+ACCESS_TYPE_COLORS = np.array(["y", "r", "b", "g", "k", "y", "y", "y", "y", "y", "y", "y", "y"])
+_ACCESS_TYPE_CODES = {name: code for code, name in enumerate(ACCESS_TYPES)}
+
+def access_type_code(name):
+    return _ACCESS_TYPE_CODES.get(name, 0)
+
+def parse_columns(filename):
+    return utils.read_typed_csv(filename, SCHEMA, converters={"act": access_type_code}, default_header=EXPORT_COLUMNS)
+
+def parse_lines(lines, header=EXPORT_COLUMNS):
+    return utils.parse_typed_lines(lines, header, SCHEMA, converters={"act": access_type_code})
+
+def load_columns(filename, use_cache=True):
+    # Reuse the columns parsed on a previous run if the file hasn't
+    # changed since then
+    columns = None
+    if use_cache:
+        with profiling.span("dataset.cache_load", file=filename):
+            columns = cache.load_columns(filename, DataSet.COLUMNS)
+    if columns is None:
+        with profiling.span("dataset.parse", file=filename) as span:
+            columns = parse_columns(filename)
+            span.set(rows=len(columns["time_range"]))
+        if use_cache:
+            with profiling.span("dataset.cache_write", file=filename):
+                cache.save_columns(filename, columns)
+    return columns
+
 class DataSet:
-    def __init__(self, filename):
-        print(filename)
+    # Columns parsed from the CSV, which are cached next to it
+    COLUMNS = [name for column, name, dtype in SCHEMA]
+
+    def __init__(self, filename, use_cache=True):
+        with profiling.span("dataset.load", file=filename) as span:
+            self.set_paths(filename)
+            self.set_columns(load_columns(filename, use_cache))
+            span.set(rows=len(self.time_range))
+
+    def set_paths(self, filename):
         self.data_file = filename
         self.data_path = self.data_file.rsplit('/', 1)[0]
         self.dataset_name = self.data_path.rsplit('/', 1)[1]
         self.map_path = self.data_path + "/map.png"
         self.bbox_path = self.data_path + "/bbox.txt"
-        self.data_matrix = np.array(utils.read_csv(filename))
+
+    def set_columns(self, columns):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.access_type_range = ACCESS_TYPES[self.access_type]
+        self.access_type_color_codes = ACCESS_TYPE_COLORS[self.access_type]
 
         # Determine start and end times of test and get a time range for the trip
-        self.time_range = np.array(self.data_matrix[1:,7], dtype=float)
         self.start_time = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(self.time_range[0]/1000.))
         self.end_time = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(self.time_range[-1]/1000.))
         self.normalized_time_range = (self.time_range - self.time_range[0])/1000
-        self.lat = np.array(self.data_matrix[1:,4], dtype=float)
-        self.lon = np.array(self.data_matrix[1:,5], dtype=float)
-
-        # get signal strength in dBm
-        self.signal_range = np.array(self.data_matrix[1:,6], dtype=float)
-
-        # get physical cell IDs
-        self.pcis = np.array(self.data_matrix[1:,15], dtype=float)
-
-        # get device speed
-        self.speed_values = np.array(self.data_matrix[1:,9], dtype=float)
-        self.mcc = np.array(self.data_matrix[1:,0], dtype=int)
-        self.mnc = np.array(self.data_matrix[1:,1], dtype=int)
-        self.lac = np.array(self.data_matrix[1:,2], dtype=int)
-        self.cellid = np.array(self.data_matrix[1:,3], dtype=int)
-        self.rating = np.array(self.data_matrix[1:,8], dtype=float)
-        self.direction = np.array(self.data_matrix[1:,10], dtype=float)
-        self.timing_advance = np.array(self.data_matrix[1:,12], dtype=float)
-
-        # get access types and convert them to usable format
-        self.access_type_range = np.array(self.data_matrix[1:,11])
-        self.access_type_color_codes = np.zeros(len(self.access_type_range), dtype="str")
-        for x in range(len(self.access_type_range)):
-            if self.access_type_range[x] == "LTE":
-                self.access_type_color_codes[x] = "r"
-            elif self.access_type_range[x] == "LTE+":
-                self.access_type_color_codes[x] = "b"
-            elif self.access_type_range[x] == "UMTS":
-                self.access_type_color_codes[x] = "g"
-            elif self.access_type_range[x] == "HSPA+":
-                self.access_type_color_codes[x] = "k"
-            else:
-                self.access_type_color_codes[x] = "y"
+        self.set_hash()
 
+    def set_hash(self):
         self.hash = {}
         self.hash['time'] = self.normalized_time_range
         self.hash['signal_strength'] = self.signal_range
@@ -69,3 +105,145 @@ class DataSet:
         self.hash['rating'] = self.rating
         self.hash['direction'] = self.direction
         self.hash['advance'] = self.timing_advance
+
+class MultiDataSet(DataSet):
+    """A DataSet combining the rows of several files, in the given order.
+
+    The files are parsed (or loaded from their caches) in a process pool,
+    and copied once into preallocated combined columns. self.source holds
+    the index in self.data_files of the file each row came from. Map and
+    bbox paths are taken from the first file.
+    """
+    def __init__(self, filenames, use_cache=True, processes=None):
+        self.data_files = list(filenames)
+        self.set_paths(self.data_files[0])
+
+        with profiling.span("dataset.load_files", files=len(self.data_files)):
+            if len(self.data_files) == 1 or processes == 1:
+                parts = [load_columns(filename, use_cache) for filename in self.data_files]
+            else:
+                # gws loads datasets from a QThread, and forking a
+                # multi-threaded process can deadlock, so the workers are
+                # started fresh instead
+                with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                    results = pool.starmap(profiling.traced_call, [(profiling.enabled, load_columns, filename, use_cache) for filename in self.data_files])
+                parts = [columns for columns, recorded in results]
+                for columns, recorded in results:
+                    profiling.merge(recorded)
+
+        with profiling.span("dataset.combine") as span:
+            sizes = [len(part["time_range"]) for part in parts]
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            columns = {name: np.empty(offsets[-1], dtype=parts[0][name].dtype) for name in self.COLUMNS}
+            for part, start, stop in zip(parts, offsets[:-1], offsets[1:]):
+                for name in self.COLUMNS:
+                    columns[name][start:stop] = part[name]
+            self.source = np.repeat(np.arange(len(self.data_files)), sizes)
+            self.set_columns(columns)
+            span.set(rows=int(offsets[-1]))
+
+class ColumnBuffer:
+    """A growable 1-D array.
+
+    The capacity doubles whenever an append doesn't fit, so appending n
+    rows costs O(n) overall, and view() returns the filled part without
+    copying. Views taken before an append that grows the buffer keep
+    pointing at the old storage.
+    """
+    def __init__(self, values):
+        self.data = np.array(values)
+        self.size = len(self.data)
+
+    def append(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            data = np.empty(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        return self.data[:self.size]
+
+class LiveDataSet(DataSet):
+    """A DataSet for a file that is still being written to.
+
+    refresh() reads only the bytes appended since the previous call and
+    appends the complete lines among them to the columns, so the cost of a
+    refresh depends on how much was added rather than on the length of
+    the file. Rows with an empty value in any column of SCHEMA (e.g. no
+    timing advance) are skipped, as groom_data does, as are rows with
+    fewer fields than the header. The file isn't cached, since it keeps
+    changing.
+    """
+    def __init__(self, filename):
+        self.set_paths(filename)
+        self.header = None
+        self.offset = 0
+        self.buffers = {name: ColumnBuffer(np.empty(0, dtype=dtype)) for column, name, dtype in SCHEMA}
+        self.buffers["access_type_range"] = ColumnBuffer(ACCESS_TYPES[:0])
+        self.buffers["access_type_color_codes"] = ColumnBuffer(ACCESS_TYPE_COLORS[:0])
+        self.buffers["normalized_time_range"] = ColumnBuffer(np.empty(0))
+        self.update_columns()
+        self.refresh()
+
+    def refresh(self):
+        """Append the rows added to the file since the last refresh, and
+        return how many there were."""
+        with profiling.span("dataset.refresh", file=self.data_file) as span:
+            with open(self.data_file, "rb") as data_file:
+                data_file.seek(self.offset)
+                chunk = data_file.read()
+            # Leave a partially written last line for the next refresh
+            end = chunk.rfind(b"\n") + 1
+            if end == 0:
+                return 0
+            lines = chunk[:end].decode("utf-8").splitlines()
+            if self.header is None:
+                lines[0] = lines[0].lstrip("\ufeff")
+                self.header = utils.read_header(lines[0], SCHEMA, EXPORT_COLUMNS)
+                if self.header is not EXPORT_COLUMNS:
+                    lines = lines[1:]
+            self.offset += end
+
+            indices = [self.header.index(column) for column, name, dtype in SCHEMA]
+            # Short lines, e.g. from a crash partway through a record, are
+            # skipped along with those missing a value
+            lines = [line for line, fields in zip(lines, [line.split(",") for line in lines])
+                     if len(fields) >= len(self.header) and all(fields[i] for i in indices)]
+            if lines:
+                columns = parse_lines(lines, self.header)
+                for name, column in columns.items():
+                    self.buffers[name].append(column)
+                self.buffers["access_type_range"].append(ACCESS_TYPES[columns["access_type"]])
+                self.buffers["access_type_color_codes"].append(ACCESS_TYPE_COLORS[columns["access_type"]])
+                time_range = self.buffers["time_range"].view()
+                self.buffers["normalized_time_range"].append((columns["time_range"] - time_range[0])/1000)
+                self.update_columns()
+            span.set(rows=len(lines))
+            return len(lines)
+
+    def update_columns(self):
+        # Point the attributes at the current extent of the buffers
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer.view())
+        if len(self.time_range):
+            self.start_time = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(self.time_range[0]/1000.))
+            self.end_time = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(self.time_range[-1]/1000.))
+        else:
+            self.start_time = self.end_time = None
+        self.set_hash()
+
+def load_dataset(filenames, use_cache=True, processes=None):
+    """Return a DataSet for a single file, or a MultiDataSet for a list.
+
+    A DataSet (e.g. a store.StoreDataSet) is returned as it is.
+    """
+    if isinstance(filenames, DataSet):
+        return filenames
+    if isinstance(filenames, str):
+        return DataSet(filenames, use_cache)
+    if len(filenames) == 1:
+        return DataSet(filenames[0], use_cache)
+    return MultiDataSet(filenames, use_cache, processes)
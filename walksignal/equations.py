@@ -1,8 +1,10 @@
+import functools
 import numpy as np
-import scipy.special as sp
 
 # Equation 12 in A Random Walk Model of Wave Propagation
 def gplt_rwm_fpd2d(obs_dens, absorption, x_range):
+    # scipy.special is slow to import, and only this model needs it
+    import scipy.special as sp
     external_multiplier = obs_dens * absorption / (2 * np.pi)
     internal_multiplier = (1 - absorption) * obs_dens
     exp_mult_1 = np.sqrt(1 - np.square(1 - absorption)) * obs_dens
@@ -27,3 +29,39 @@ def gplt_rwm_fpd3d(obs_dens, absorption, x_range):
     rwm_y = 10 * np.log10(g_r / (absorption * obs_dens)) + 30
 
     return rwm_y
+
+MODELS = {
+    "2d": gplt_rwm_fpd2d,
+    "3d": gplt_rwm_fpd3d,
+}
+
+def rwm_grid(model, densities, absorptions, x_range):
+    """Evaluate a model for many (density, absorption) pairs at once.
+
+    densities and absorptions are broadcast against each other, and the
+    result has their broadcast shape followed by the shape of x_range, so
+    passing two 1-D arrays of pairs returns a 2-D array with one row per
+    pair. Use np.meshgrid on the inputs to evaluate a full grid.
+    """
+    densities, absorptions = np.broadcast_arrays(np.asarray(densities, dtype=float), np.asarray(absorptions, dtype=float))
+    x_range = np.asarray(x_range, dtype=float)
+    expand = (Ellipsis,) + (np.newaxis,) * x_range.ndim
+    return MODELS[model](densities[expand], absorptions[expand], x_range)
+
+@functools.lru_cache(maxsize=1024)
+def _cached_rwm(model, obs_dens, absorption, x_bytes, x_shape):
+    x_range = np.frombuffer(x_bytes, dtype=float).reshape(x_shape)
+    rwm_y = MODELS[model](obs_dens, absorption, x_range)
+    rwm_y.flags.writeable = False
+    return rwm_y
+
+def cached_rwm(model, obs_dens, absorption, x_range):
+    """Evaluate a model through a bounded LRU cache.
+
+    Results are keyed on the model, parameters and the contents of
+    x_range, so moving a slider back to a previous value costs a lookup
+    rather than a recomputation. The returned array is shared between
+    callers and is read-only.
+    """
+    x_range = np.ascontiguousarray(x_range, dtype=float)
+    return _cached_rwm(model, float(obs_dens), float(absorption), x_range.tobytes(), x_range.shape)
@@ -0,0 +1,100 @@
+import collections
+import csv
+import multiprocessing
+import numpy as np
+import scipy.optimize as optimize
+import walksignal.equations as equations
+
+FitResult = collections.namedtuple("FitResult", ["mcc", "mnc", "lac", "cellid", "model", "density", "absorption", "rmse", "samples", "success"])
+
+# Coarse grid searched before refining with least squares
+DENSITY_GRID = np.linspace(0.01, 1.0, 100)
+ABSORPTION_GRID = np.linspace(0.01, 0.99, 99)
+
+# Largest number of model evaluations held in memory at once by
+# grid_search, i.e. about 8 MB per temporary array
+GRID_CHUNK_ELEMENTS = 1000000
+
+# The models aren't defined at the tower itself, so samples closer than
+# this (in m) are left out of fits
+MIN_DISTANCE = 1.0
+
+# Residual used where a model is not finite, e.g. where it underflows far
+# from the tower for extreme parameters
+NONFINITE_RESIDUAL = 1e3
+
+def model_residuals(model, obs_dens, absorption, distances, power):
+    with np.errstate(all="ignore"):
+        residuals = equations.MODELS[model](obs_dens, absorption, distances) - power
+    return np.where(np.isfinite(residuals), residuals, NONFINITE_RESIDUAL)
+
+def grid_search(model, distances, power, densities=DENSITY_GRID, absorptions=ABSORPTION_GRID):
+    """Return the (density, absorption) pair on the grid with the lowest
+    sum of squared residuals.
+
+    The whole grid is evaluated at once for a block of distances at a
+    time, so memory use is bounded by GRID_CHUNK_ELEMENTS however many
+    samples a tower has.
+    """
+    grid_dens, grid_abs = np.meshgrid(densities, absorptions)
+    distances = np.asarray(distances, dtype=float)
+    power = np.asarray(power, dtype=float)
+    block = max(1, GRID_CHUNK_ELEMENTS // grid_dens.size)
+    sse = np.zeros(grid_dens.shape)
+    for start in range(0, len(distances), block):
+        with np.errstate(all="ignore"):
+            residuals = equations.rwm_grid(model, grid_dens, grid_abs, distances[start:start + block]) - power[start:start + block]
+        residuals = np.where(np.isfinite(residuals), residuals, NONFINITE_RESIDUAL)
+        sse += np.sum(np.square(residuals), axis=-1)
+    best = np.unravel_index(np.argmin(sse), grid_dens.shape)
+    return grid_dens[best], grid_abs[best]
+
+def fit_model(model, distances, power):
+    """Fit one model to a tower's power vs distance data.
+
+    Returns the fitted density and absorption, the RMS residual in dB and
+    whether the least squares refinement converged.
+    """
+    distances = np.asarray(distances, dtype=float)
+    power = np.asarray(power, dtype=float)
+    start = grid_search(model, distances, power)
+    result = optimize.least_squares(lambda params: model_residuals(model, params[0], params[1], distances, power),
+                                    start, bounds=([1e-6, 1e-6], [np.inf, 1.0]))
+    rmse = np.sqrt(np.mean(np.square(result.fun)))
+    return float(result.x[0]), float(result.x[1]), float(rmse), bool(result.success)
+
+def fit_tower_data(key, distances, power, models=("2d", "3d")):
+    distances = np.asarray(distances, dtype=float)
+    power = np.asarray(power, dtype=float)
+    fitted = distances >= MIN_DISTANCE
+    distances, power = distances[fitted], power[fitted]
+    results = []
+    for model in models:
+        if len(distances) == 0:
+            results.append(FitResult(*key, model, np.nan, np.nan, np.nan, 0, False))
+            continue
+        density, absorption, rmse, success = fit_model(model, distances, power)
+        results.append(FitResult(*key, model, density, absorption, rmse, len(distances), success))
+    return results
+
+def fit_tower(tower, models=("2d", "3d")):
+    return fit_tower_data((tower.mcc, tower.mnc, tower.lac, tower.cellid), tower.distances, tower.signal_power, models)
+
+def fit_towers(tower_list, models=("2d", "3d"), processes=None):
+    """Fit every model to every tower in tower_list, in a process pool.
+
+    Returns a list of FitResults, one per tower and model.
+    """
+    jobs = [((tower.mcc, tower.mnc, tower.lac, tower.cellid), np.asarray(tower.distances), np.asarray(tower.signal_power), models) for tower in tower_list.tower_list]
+    if processes == 1:
+        fits = [fit_tower_data(*job) for job in jobs]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            fits = pool.starmap(fit_tower_data, jobs)
+    return [result for tower_fits in fits for result in tower_fits]
+
+def write_results(results, filename):
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FitResult._fields)
+        writer.writerows(results)
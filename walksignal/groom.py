@@ -0,0 +1,138 @@
+import csv
+import heapq
+import multiprocessing
+import os
+import tempfile
+import walksignal.cache as cache
+import walksignal.data as data
+import walksignal.utils as utils
+
+# Number of rows written to the output and its cache at a time
+CHUNK_ROWS = 10000
+
+MEASURED_AT = data.EXPORT_COLUMNS.index("measured_at")
+
+# Rows missing any of these are dropped, since DataSet can't load them. In
+# practice this is nearly always the timing advance
+REQUIRED = [data.EXPORT_COLUMNS.index(column) for column, name, dtype in data.SCHEMA]
+
+# Rows with the same values in these columns are duplicates, however the
+# numbers are written (e.g. "2" and "2.0"). Floats compare integer ids
+# exactly, and every column here is required
+IDENTITY = [data.EXPORT_COLUMNS.index(column) for column in ("mcc", "mnc", "lac", "cellid", "measured_at", "lat", "lon", "signal")]
+
+def read_rows(filename):
+    """Yield the rows of an export as lists in EXPORT_COLUMNS order.
+
+    Exports with a header may have their columns in any order. Files
+    without one (such as .pruned files) are assumed to already be in
+    EXPORT_COLUMNS order.
+    """
+    with open(filename, encoding="utf-8-sig", newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        first = next(reader, None)
+        if first is None:
+            return
+        header = utils.read_header(",".join(first), data.SCHEMA, data.EXPORT_COLUMNS)
+        if header is data.EXPORT_COLUMNS:
+            yield first
+            yield from reader
+            return
+        positions = [header.index(column) if column in header else None for column in data.EXPORT_COLUMNS]
+        for row in reader:
+            yield [row[i] if i is not None and i < len(row) else "" for i in positions]
+
+def complete(row):
+    return len(row) == len(data.EXPORT_COLUMNS) and all(row[i] for i in REQUIRED)
+
+def timed_rows(filename):
+    """Yield (measured_at, row) for each complete row of filename.
+
+    The files are merged on the assumption that each one is in time
+    order, as exports normally are. A file that isn't is reported, and
+    should be groomed with sort=True.
+    """
+    last = float("-inf")
+    warned = False
+    for row in read_rows(filename):
+        if not complete(row):
+            continue
+        measured_at = float(row[MEASURED_AT])
+        if measured_at < last and not warned:
+            print("{0} is not in measured_at order, so it may be merged out of order. Use --sort".format(filename))
+            warned = True
+        last = measured_at
+        yield measured_at, row
+
+def sort_file(filename, directory):
+    # Write the complete rows of filename to a file in directory, sorted
+    # by measured_at. Only one file is held in memory at a time
+    rows = sorted((row for row in read_rows(filename) if complete(row)), key=lambda row: float(row[MEASURED_AT]))
+    handle, path = tempfile.mkstemp(suffix=".csv", dir=directory)
+    with os.fdopen(handle, "w") as sorted_file:
+        for row in rows:
+            sorted_file.write(",".join(row) + "\n")
+    return path
+
+def write_chunk(output_file, writer, lines):
+    if not lines:
+        return
+    output_file.write("\n".join(lines) + "\n")
+    if writer:
+        writer.append(data.parse_lines(lines))
+
+def groom_files(filenames, output, sort=False, processes=None, use_cache=True):
+    """Merge exports into a single pruned file, in one streaming pass.
+
+    Rows missing a value that DataSet needs (usually the timing advance)
+    are dropped, and rows repeated in overlapping exports (the same cell,
+    time, position and signal) are only kept once. The files are merged
+    by measured_at, which only needs one row of each file in memory at a
+    time. Files that aren't already in time order can be sorted first
+    with sort=True, in a pool of processes; this holds one whole file in
+    memory per process.
+
+    The output has no header, like the .pruned files written by earlier
+    versions, and its column cache is written alongside it unless
+    use_cache is False, so that the first DataSet load doesn't have to
+    parse it. Returns the number of rows written and of duplicates
+    dropped.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as directory:
+        if sort:
+            if len(filenames) == 1 or processes == 1:
+                sources = [sort_file(filename, directory) for filename in filenames]
+            else:
+                with multiprocessing.Pool(processes) as pool:
+                    sources = pool.starmap(sort_file, [(filename, directory) for filename in filenames])
+        else:
+            sources = list(filenames)
+
+        writer = None
+        if use_cache:
+            writer = cache.ColumnWriter(output, {name: dtype for column, name, dtype in data.SCHEMA})
+        written = duplicates = 0
+        # Duplicates have the same measurement time, so only the rows of
+        # the current time need to be remembered
+        current = None
+        seen = set()
+        lines = []
+        with open(output, "w") as output_file:
+            for measured_at, row in heapq.merge(*(timed_rows(source) for source in sources), key=lambda item: item[0]):
+                if measured_at != current:
+                    current = measured_at
+                    seen = set()
+                key = tuple(float(row[i]) for i in IDENTITY)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                lines.append(",".join(row))
+                written += 1
+                if len(lines) == CHUNK_ROWS:
+                    write_chunk(output_file, writer, lines)
+                    lines = []
+            write_chunk(output_file, writer, lines)
+        if writer:
+            writer.close()
+    return written, duplicates
@@ -1,39 +1,63 @@
 #!/usr/bin/python3 
-import csv
 import sys
 import numpy as np
-import scipy.special as sp
-import time
-import utm
-import math
-import argparse
-import requests
-import matplotlib
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-matplotlib.use('Qt5Agg')
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from geopy import distance
 import walksignal.data as data
-import walksignal.plottools as plottools
+import walksignal.equations as equations
+import walksignal.profiling as profiling
+from walksignal.equations import gplt_rwm_fpd2d, gplt_rwm_fpd3d
 import walksignal.towers as towers
 import walksignal.utils as utils
 
-class MplCanvas(FigureCanvas):
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        super(MplCanvas, self).__init__(self.fig)
+# Number of columns of cells across the visible map in raster mode
+RASTER_BINS = 100
 
 class PlotData:
-    def __init__(self, datafile, reference_file):
-        self.dataset = data.DataSet(datafile)
-        self.tower_list = towers.TowerList(self.dataset.data_matrix, reference_file)
-        self.tower_lat_data = self.tower_list.lats
-        self.tower_lon_data = self.tower_list.lons
+    """The dataset, towers and map used by the plotting functions.
+
+    progress, if given, is called as progress(stage, plot_data) as each
+    stage of loading starts, and may raise to abandon the load. The
+    matplotlib figure is only created if figure is True, so that gws can
+    build a PlotData off the GUI thread. If live is True, datafile is a
+    single file that is still being written, and refresh() adds the rows
+    appended to it since the last call.
+    """
+    def __init__(self, datafile, reference_file, progress=None, figure=True, live=False):
+        progress = progress or (lambda stage, plot_data: None)
+        progress("dataset", self)
+        with profiling.span("plot_data.load_dataset"):
+            if live:
+                self.dataset = data.LiveDataSet(datafile)
+            else:
+                self.dataset = data.load_dataset(datafile)
+        self.mcc_u = np.unique(self.dataset.mcc)
+        self.mnc_u = np.unique(self.dataset.mnc)
+        self.lac_u = np.unique(self.dataset.lac)
+        self.cellid_u = np.unique(self.dataset.cellid)
+        self.set_data()
+        progress("tower ids", self)
+
+        with profiling.span("plot_data.tower_list"):
+            self.tower_list = towers.TowerList(self.dataset, reference_file, progress=lambda stage: progress(stage, self))
+        self.set_tower_data()
+        progress("map", self)
+        self.plot_map = None
+        self.map_bbox = None
+        with profiling.span("plot_data.get_map_and_bbox", file=self.dataset.map_path):
+            self.get_map_and_bbox()
+        self.fig = None
+        self.ax1 = None
+        if figure:
+            with profiling.span("plot_data.setup_figure"):
+                self.setup_figure()
+        self.cm = plt.get_cmap('gist_heat')
+        self.cm2 = plt.get_cmap('gist_gray')
+        self.distances = np.array([])
+        self.plotrange = np.linspace(1, 500, 250)
+
+    def set_data(self):
         self.lat_data = self.dataset.lat
         self.lon_data = self.dataset.lon
         self.signal_data = self.dataset.signal_range
@@ -44,43 +68,62 @@ class PlotData:
         self.mnc = self.dataset.mnc
         self.lac = self.dataset.lac
         self.cellid = self.dataset.cellid
-        self.mcc_u = np.unique(self.mcc)
-        self.mnc_u = np.unique(self.mnc)
-        self.lac_u = np.unique(self.lac)
-        self.cellid_u = np.unique(self.cellid)
-        self.plot_map = None
-        self.map_bbox = None
-        self.get_map_and_bbox()
-        self.fig = plt.figure()
-        self.ax1 = self.fig.add_subplot(111)
-        self.set_image()
-        self.cm = plt.cm.get_cmap('gist_heat')
-        self.cm2 = plt.cm.get_cmap('gist_gray')
-        self.avg_lat_diff = np.average(np.ediff1d(self.lat_data))
-        self.avg_lon_diff = np.average(np.ediff1d(self.lon_data))
-        self.distances = np.array([])
-        self.plotrange = np.linspace(1, 500, 250)
+        # The average of the differences between consecutive points, which
+        # only depends on the first and last points
+        steps = max(len(self.lat_data) - 1, 1)
+        self.avg_lat_diff = (self.lat_data[-1] - self.lat_data[0])/steps if len(self.lat_data) else 0.0
+        self.avg_lon_diff = (self.lon_data[-1] - self.lon_data[0])/steps if len(self.lon_data) else 0.0
+
+    def set_tower_data(self):
+        self.tower_lat_data = self.tower_list.lats
+        self.tower_lon_data = self.tower_list.lons
+
+    def refresh(self):
+        """Add the rows appended to a live dataset since the last refresh.
+
+        Returns the towers that gained data points. Only the new rows are
+        parsed, matched to towers and measured, so a refresh doesn't get
+        slower as the file grows.
+        """
+        start = len(self.dataset.mcc)
+        if not self.dataset.refresh():
+            return []
+        self.mcc_u = np.union1d(self.mcc_u, self.dataset.mcc[start:])
+        self.mnc_u = np.union1d(self.mnc_u, self.dataset.mnc[start:])
+        self.lac_u = np.union1d(self.lac_u, self.dataset.lac[start:])
+        self.cellid_u = np.union1d(self.cellid_u, self.dataset.cellid[start:])
+        self.set_data()
+        updated = self.tower_list.update()
+        self.set_tower_data()
+        return updated
 
     def get_map_and_bbox(self):
+        if self.dataset.map_path is None:
+            raise ValueError("{0} has no single map, select one area".format(self.dataset.dataset_name))
         self.plot_map = plt.imread(self.dataset.map_path)
         self.map_bbox = [entry for entry in utils.get_bbox(self.dataset.bbox_path)]
 
+    def setup_figure(self):
+        self.fig = plt.figure()
+        self.ax1 = self.fig.add_subplot(111)
+        self.set_image()
+
     def set_image(self):
         self.ax1.imshow(self.plot_map, zorder=0, extent = self.map_bbox[0], aspect="equal")
 
-def plot_rating(datafile, reference_file):
+def plot_rating(datafile, reference_file, raster=False, stat="mean", bins=RASTER_BINS):
     setup = PlotData(datafile, reference_file)
 
-    signals = plt_signal_scatter(setup.ax1, setup.lon_data, setup.lat_data, setup.rating, setup.cm)
+    signals = plt_signal_layer(setup, setup.lon_data, setup.lat_data, setup.rating, raster, stat, bins)
     tower_plot = plt_points_scatter(setup.ax1, setup.tower_lon_data, setup.tower_lat_data, "blue")
     plt_set_bbox(plt, setup.map_bbox)
     plt_set_label(title="Rating vs Position")
-    plt_set_colorbar(setup, signals, "Rating (m)")
+    plt_set_colorbar(setup, signals, raster_label("Rating (m)", raster, stat))
     
     plt.show()
 
 def plot_data(x_axis, y_axis, annotation=None, x_label="X", y_label="Y", plot_title="X vs Y"):
-    scatter = plt_points_scatter(x_axis, y_axis, c = annotation, s = 2)
+    scatter = plt.scatter(x_axis, y_axis, c = annotation, s = 2)
     if annotation is not None:
         for element in range(len(x_axis)):
             if annotation[element] is not None:
@@ -104,27 +147,7 @@ def plot_data(x_axis, y_axis, annotation=None, x_label="X", y_label="Y", plot_ti
 
 def plot_positioning(datafile, reference_file):
     setup = PlotData(datafile, reference_file)
-    corrected_lat = []
-    corrected_lon = []
-
-    for entry in range(len(setup.lat_data)):
-        corrected_lat.append(setup.lat_data[entry])
-        corrected_lon.append(setup.lon_data[entry])
-    for entry in range(len(setup.lat_data) - 1):
-        corr = 1.01
-        proj_lat, proj_lon = utils.project_next_position(setup.lat_data[entry], setup.lon_data[entry], setup.speed_values[entry], setup.direction[entry])
-        proj_diff_lat = np.absolute(setup.lat_data[entry] - proj_lat)
-        proj_diff_lon = np.absolute(setup.lon_data[entry] - proj_lon)
-        orig_diff_lat = np.absolute(setup.lat_data[entry] - setup.lat_data[entry+1])
-        orig_diff_lon = np.absolute(setup.lon_data[entry] - setup.lon_data[entry+1])
-
-        if ((orig_diff_lat > proj_diff_lat * corr) and (orig_diff_lon > proj_diff_lon * corr)):
-            corrected_lat[entry] = proj_lat
-            corrected_lon[entry] = proj_lon
-        elif (orig_diff_lat > proj_diff_lat * corr):
-            corrected_lat[entry] = proj_lat
-        elif (orig_diff_lon > proj_diff_lon * corr):
-            corrected_lon[entry] = proj_lon
+    corrected_lat, corrected_lon = utils.correct_positions(setup.lat_data, setup.lon_data, setup.speed_values, setup.direction)
 
     plot = plt_signal_scatter(setup.ax1, setup.lon_data, setup.lat_data, setup.signal_data, setup.cm)
     plot2 = plt_signal_scatter(setup.ax1, corrected_lon, corrected_lat, setup.signal_data, setup.cm2)
@@ -134,39 +157,31 @@ def plot_positioning(datafile, reference_file):
 
     plt.show()
 
-def plot_gsp(datafile, reference_file):
+def plot_gsp(datafile, reference_file, raster=False, stat="mean", bins=RASTER_BINS):
     setup = PlotData(datafile, reference_file)
 
-    signals = plt_signal_scatter(setup.ax1, setup.lon_data, setup.lat_data, setup.signal_data, setup.cm)
+    signals = plt_signal_layer(setup, setup.lon_data, setup.lat_data, setup.signal_data, raster, stat, bins)
     tower_plot = plt_points_scatter(setup.ax1, setup.tower_lon_data, setup.tower_lat_data, "blue")
     plt_set_bbox(plt, setup.map_bbox)
     plt_set_label()
-    plt_set_colorbar(setup, signals)
+    plt_set_colorbar(setup, signals, raster_label("Signal Power(dBm)", raster, stat))
 
     plt.show()
 
-def plot_towerdata(datafile, reference_file, mcc, mnc, lac, cellid):
+def plot_towerdata(datafile, reference_file, mcc, mnc, lac, cellid, raster=False, stat="mean", bins=RASTER_BINS):
     setup = PlotData(datafile, reference_file)
-    plot_tower = None
-
-    for tower in setup.tower_list.tower_list:
-        if ((tower.mcc == mcc) and (tower.mnc == mnc) and (tower.lac == lac) and (tower.cellid == cellid)):
-            plot_tower = tower
+    plot_tower = setup.tower_list.get_tower_data(mcc, mnc, lac, cellid)
 
     if plot_tower is None:
         print("Tower not found based on inputs")
         sys.exit()
 
-    points = plot_tower.data_points
-    lon_series = np.array([point.lon for point in points], dtype=float)
-    lat_series = np.array([point.lat for point in points], dtype=float)
-
-    plot = plt_signal_scatter(setup.ax1, lon_series, lat_series, plot_tower.signal_power, setup.cm)
+    plot = plt_signal_layer(setup, plot_tower.lon_series, plot_tower.lat_series, plot_tower.signal_power, raster, stat, bins)
     plot2 = plt_points_scatter(setup.ax1, float(plot_tower.lon), float(plot_tower.lat))
 
     plt_set_bbox(plt, setup.map_bbox)
     plt_set_label()
-    plt_set_colorbar(setup, plot)
+    plt_set_colorbar(setup, plot, raster_label("Signal Power(dBm)", raster, stat))
 
     plt.show()
 
@@ -191,13 +206,28 @@ def plot_towerdata(datafile, reference_file, mcc, mnc, lac, cellid):
 
     plt.show()
 
+def fit_all_towers(datafile, reference_file, output=None):
+    # fitting pulls in scipy.optimize, which plotting doesn't need
+    import walksignal.fitting as fitting
+
+    dataset = data.load_dataset(datafile)
+    tower_list = towers.TowerList(dataset, reference_file)
+    results = fitting.fit_towers(tower_list)
+
+    if output:
+        fitting.write_results(results, output)
+    else:
+        print("{:>4} {:>4} {:>6} {:>10} {:>5} {:>8} {:>10} {:>8} {:>7}".format("mcc", "mnc", "lac", "cellid", "model", "density", "absorption", "rmse", "samples"))
+        for result in results:
+            print("{:>4} {:>4} {:>6} {:>10} {:>5} {:>8.4f} {:>10.4f} {:>8.3f} {:>7}".format(*result[:-1]))
+
 def plt_set_label(x_label="Longitude", x_rot=0, y_label="Latitude", y_rot=90, title="Signal Power vs Position"):
     plt.ylabel(y_label, rotation=y_rot)
     plt.xlabel(x_label, rotation=x_rot)
     plt.title(title)
 
 def plt_set_colorbar(setup, plot, label="Signal Power(dBm)"):
-    ax = plt.axes()
+    ax = setup.ax1
     # Make sure to prevent lat/long from being displayed in scientific
     # notation
     fmtr = ticker.FormatStrFormatter('% 1.4f')
@@ -214,59 +244,67 @@ def plt_set_bbox(plt, bbox):
 def plt_signal_scatter(ax, lon_data, lat_data, signal_data, cm):
     return ax.scatter(lon_data, lat_data, zorder=1, alpha=1.0, s=20, c=signal_data, cmap=cm)
 
+def plt_signal_layer(setup, lon_data, lat_data, signal_data, raster=False, stat="mean", bins=RASTER_BINS):
+    # Plot samples individually, or binned into a SignalRaster
+    if raster:
+        return SignalRaster(setup.ax1, lon_data, lat_data, signal_data, setup.cm, stat, bins).image
+    return plt_signal_scatter(setup.ax1, lon_data, lat_data, signal_data, setup.cm)
+
+def raster_label(label, raster=False, stat="mean"):
+    if not raster:
+        return label
+    if stat == "count":
+        return "Samples per cell"
+    return "{0} of {1}".format(stat.capitalize(), label)
+
+class SignalRaster:
+    """A heatmap of samples binned into a grid over the visible map.
+
+    Each cell shows the mean, max or count (stat) of the values of the
+    samples inside it, drawn as a single image instead of one marker per
+    sample. The visible area is split into bins columns and as many rows
+    as give square cells, and it is binned again whenever the axes are
+    zoomed or panned, so the cells shrink as you zoom in.
+    """
+    def __init__(self, ax, lon_data, lat_data, values, cm, stat="mean", bins=RASTER_BINS):
+        self.ax = ax
+        self.lon_data = np.asarray(lon_data, dtype=float)
+        self.lat_data = np.asarray(lat_data, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.stat = stat
+        self.bins = bins
+        self.extent = None
+        self.image = ax.imshow(np.full((1, 1), np.nan), zorder=1, cmap=cm, origin="lower", interpolation="nearest", aspect="equal",
+                               extent=ax.get_xlim() + ax.get_ylim())
+        # Means and maxima keep the same colour scale at every zoom level,
+        # while counts depend on the cell size
+        if stat != "count" and len(self.values):
+            self.image.set_clim(np.min(self.values), np.max(self.values))
+        # The callbacks hold a strong reference to the lambdas, and through
+        # them to the raster
+        ax.callbacks.connect("xlim_changed", lambda ax: self.update())
+        ax.callbacks.connect("ylim_changed", lambda ax: self.update())
+        self.update()
+
+    def update(self):
+        x_min, x_max = sorted(self.ax.get_xlim())
+        y_min, y_max = sorted(self.ax.get_ylim())
+        extent = (x_min, x_max, y_min, y_max)
+        if extent == self.extent or x_min == x_max or y_min == y_max:
+            return
+        self.extent = extent
+        rows = max(1, int(round(self.bins * (y_max - y_min) / (x_max - x_min))))
+        grid = utils.bin_values(self.lon_data, self.lat_data, self.values, extent, (rows, self.bins), self.stat)
+        self.image.set_data(np.ma.masked_invalid(grid))
+        self.image.set_extent(extent)
+        if self.stat == "count":
+            self.image.autoscale()
+
 def plt_points_scatter(ax, lon_data, lat_data, col="blue"):
     return ax.scatter(lon_data, lat_data, zorder=1, alpha=1.0, s=20, color=col)
 
-# Equation 12 in A Random Walk Model of Wave Propagation
 def plt_rwm_fpd2d(obs_dens, absorption, x_range, color="red", marker="-"):
-    external_multiplier = obs_dens * absorption / (2 * np.pi)
-    internal_multiplier = (1 - absorption) * obs_dens
-    exp_mult_1 = np.sqrt(1 - np.square(1 - absorption)) * obs_dens
-    exp_mult_2 = -1 * (1 - np.square(1 - absorption)) * obs_dens
-    bessel = internal_multiplier * sp.kv(0, exp_mult_1 * x_range)
-    first_component = internal_multiplier * np.multiply(x_range, bessel)
-    second_component = np.exp(exp_mult_2 * x_range)
-    g_r = external_multiplier * np.multiply(np.add(first_component, second_component), x_range)
-    rwm_y = 10 * np.log10(g_r / (absorption * obs_dens)) + 30
-
-    plt.plot(x_range, rwm_y, linestyle=marker, color=color)
-
-# Equation 12 in A Random Walk Model of Wave Propagation
+    plt.plot(x_range, equations.cached_rwm("2d", obs_dens, absorption, x_range), linestyle=marker, color=color)
+
 def plt_rwm_fpd3d(obs_dens, absorption, x_range, color="red", marker="-"):
-    external_multiplier = obs_dens * absorption / (4 * np.pi)
-    internal_multiplier = (1 - absorption) * obs_dens
-    exp_mult_1 = np.sqrt(1 - np.square(1 - absorption)) * obs_dens
-    exp_mult_2 = -1 * (1 - np.square(1 - absorption)) * obs_dens
-    first_component = internal_multiplier * np.multiply(x_range, np.exp(-1 * exp_mult_1 * x_range))
-    second_component = np.exp(exp_mult_2 * x_range)
-    g_r = external_multiplier * np.multiply(np.add(first_component, second_component), x_range)
-    rwm_y = 10 * np.log10(g_r / (absorption * obs_dens)) + 30
-
-    plt.plot(x_range, rwm_y, linestyle=marker, color=color)
-
-# Equation 12 in A Random Walk Model of Wave Propagation
-def gplt_rwm_fpd2d(obs_dens, absorption, x_range):
-    external_multiplier = obs_dens * absorption / (2 * np.pi)
-    internal_multiplier = (1 - absorption) * obs_dens
-    exp_mult_1 = np.sqrt(1 - np.square(1 - absorption)) * obs_dens
-    exp_mult_2 = -1 * (1 - np.square(1 - absorption)) * obs_dens
-    bessel = internal_multiplier * sp.kv(0, exp_mult_1 * x_range)
-    first_component = internal_multiplier * np.multiply(x_range, bessel)
-    second_component = np.exp(exp_mult_2 * x_range)
-    g_r = external_multiplier * np.multiply(np.add(first_component, second_component), x_range)
-    rwm_y = 10 * np.log10(g_r / (absorption * obs_dens)) + 30
-
-    return rwm_y
-
-# Equation 12 in A Random Walk Model of Wave Propagation
-def gplt_rwm_fpd3d(obs_dens, absorption, x_range):
-    external_multiplier = obs_dens * absorption / (4 * np.pi)
-    internal_multiplier = (1 - absorption) * obs_dens
-    exp_mult_1 = np.sqrt(1 - np.square(1 - absorption)) * obs_dens
-    exp_mult_2 = -1 * (1 - np.square(1 - absorption)) * obs_dens
-    first_component = internal_multiplier * np.multiply(x_range, np.exp(-1 * exp_mult_1 * x_range))
-    second_component = np.exp(exp_mult_2 * x_range)
-    g_r = external_multiplier * np.multiply(np.add(first_component, second_component), x_range)
-    rwm_y = 10 * np.log10(g_r / (absorption * obs_dens)) + 30
-
-    return rwm_y
+    plt.plot(x_range, equations.cached_rwm("3d", obs_dens, absorption, x_range), linestyle=marker, color=color)
@@ -0,0 +1,124 @@
+"""Named, timed spans for finding where loading time goes.
+
+Profiling is off unless the WALKSIGNAL_PROFILE environment variable is
+set to an output path, or enable() is called (e.g. by the --profile
+option of ws, gws and plot_pair). While it is off, span() returns a
+shared no-op context manager, so instrumented code pays only for the
+function call. While it is on, every span records its wall time, any
+counts attached to it (such as rows) and the peak resident memory of the
+process at its end. The spans are written as a Chrome trace JSON file
+when the process exits, which can be opened in chrome://tracing or
+https://ui.perfetto.dev. Spans recorded in pool workers are returned to
+the parent with traced_call() and merge(), keeping their own pid.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENV_VAR = "WALKSIGNAL_PROFILE"
+
+enabled = False
+output_path = None
+events = []
+_lock = threading.Lock()
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.args["peak_memory_mb"] = peak_memory_mb()
+        event = {"name": self.name, "ph": "X", "ts": self.start * 1e6, "dur": (end - self.start) * 1e6,
+                 "pid": os.getpid(), "tid": threading.get_ident(), "args": self.args}
+        with _lock:
+            events.append(event)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+def span(name, **args):
+    """Return a context manager timing the block it wraps as name.
+
+    Keyword arguments, and any set later with .set(), are stored with the
+    span, e.g. span("dataset.parse", file=filename) then s.set(rows=n).
+    """
+    if not enabled:
+        return _NULL_SPAN
+    return Span(name, args)
+
+def enable(path):
+    """Start recording spans, and write them to path on exit."""
+    global enabled, output_path
+    if not enabled:
+        atexit.register(write)
+    enabled = True
+    output_path = path
+
+def traced_call(trace, func, *args):
+    """Call func(*args) in a pool worker and return its result along with
+    the spans it recorded, which the parent adds to its own with merge().
+
+    Workers don't inherit enable() from the parent, so trace should be
+    the parent's enabled flag. Nothing is recorded when it is False.
+    """
+    global enabled
+    if not trace:
+        return func(*args), []
+    enabled = True
+    with _lock:
+        del events[:]
+    result = func(*args)
+    with _lock:
+        recorded = list(events)
+        del events[:]
+    return result, recorded
+
+def merge(recorded):
+    """Add spans recorded by traced_call() in another process."""
+    with _lock:
+        events.extend(recorded)
+
+def write(path=None):
+    path = path or output_path
+    with _lock:
+        trace = {"traceEvents": list(events), "displayTimeUnit": "ms"}
+    with open(path, "w") as f:
+        json.dump(trace, f, default=str)
+    print("Wrote profile of {0} spans to {1}".format(len(trace["traceEvents"]), path))
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
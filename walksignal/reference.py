@@ -0,0 +1,133 @@
+import array
+import csv
+import numpy as np
+import walksignal.cache as cache
+import walksignal.profiling as profiling
+
+# Column positions in OpenCellID reference files:
+# radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+MCC, MNC, LAC, CELLID, LON, LAT, RANGE = 1, 2, 3, 4, 6, 7, 8
+
+def row_key(row):
+    return (int(row[MCC]), int(row[MNC]), int(row[LAC]), int(row[CELLID]))
+
+def parse_key(fields):
+    # The key of a row of str or bytes fields, or None for the header and
+    # malformed rows. Both read_reference and the index parse keys this
+    # way, so that "0302" or "302 " match the same cells either way
+    try:
+        return row_key(fields)
+    except (ValueError, IndexError):
+        return None
+
+def in_bbox(row, bbox):
+    lon_min, lon_max, lat_min, lat_max = bbox
+    return lon_min <= float(row[LON]) <= lon_max and lat_min <= float(row[LAT]) <= lat_max
+
+def read_reference(reference_file, keys=None, bbox=None):
+    """Stream the rows of reference_file that match keys and bbox.
+
+    keys is an iterable of (mcc, mnc, lac, cellid) tuples and bbox is a
+    (lon_min, lon_max, lat_min, lat_max) tuple as returned by
+    utils.get_bbox. Either can be None to skip that filter. Rows are
+    returned as lists of strings, like utils.read_csv, but only matching
+    rows are ever kept in memory.
+    """
+    wanted = None if keys is None else {tuple(int(value) for value in key) for key in keys}
+    matches = []
+    with open(reference_file, newline="") as f:
+        for row in csv.reader(f):
+            key = parse_key(row)
+            if key is None:
+                continue
+            if wanted is not None and key not in wanted:
+                continue
+            if bbox is not None and not in_bbox(row, bbox):
+                continue
+            matches.append(row)
+    return matches
+
+def build_index(reference_file):
+    """Build and cache an index of the row offsets in reference_file.
+
+    The index is a set of columns sorted by cell ID, which is saved in the
+    reference file's .cache directory and reused until the file changes.
+    Returns None if the index couldn't be saved.
+    """
+    # Typed arrays take 8 bytes per value, rather than a Python int and a
+    # share of a tuple per value, so a country or world dump fits in memory
+    mcc, mnc, lac, cellid, offsets = (array.array("q") for i in range(5))
+    with profiling.span("reference.build_index", file=reference_file) as span, open(reference_file, "rb") as f:
+        offset = 0
+        for line in f:
+            key = parse_key(line.split(b",", CELLID + 1))
+            if key is not None:
+                mcc.append(key[0])
+                mnc.append(key[1])
+                lac.append(key[2])
+                cellid.append(key[3])
+                offsets.append(offset)
+            offset += len(line)
+        span.set(rows=len(offsets))
+
+    cellid = np.frombuffer(cellid, dtype=np.int64)
+    order = np.argsort(cellid, kind="stable")
+    index = {
+        "index_mcc": np.frombuffer(mcc, dtype=np.int64)[order],
+        "index_mnc": np.frombuffer(mnc, dtype=np.int64)[order],
+        "index_lac": np.frombuffer(lac, dtype=np.int64)[order],
+        "index_cellid": cellid[order],
+        "index_offset": np.frombuffer(offsets, dtype=np.int64)[order],
+    }
+    if not cache.save_columns(reference_file, index):
+        return None
+    return index
+
+def load_index(reference_file):
+    """Return the index of reference_file, building it if needed.
+
+    Returns None if there is no index and it can't be saved, e.g. because
+    the data directory is read-only, since rebuilding it on every load
+    would cost more than scanning the file.
+    """
+    index = cache.load_columns(reference_file, ["index_mcc", "index_mnc", "index_lac", "index_cellid", "index_offset"])
+    if index is None and cache.writable(reference_file):
+        index = build_index(reference_file)
+    return index
+
+def lookup_reference(reference_file, keys, bbox=None):
+    """Return the rows of reference_file that match keys, using its index.
+
+    Only the matching rows are read from disk, by seeking to the offsets
+    stored in the index, which is built on first use. The whole file is
+    scanned with read_reference instead if the index can't be cached.
+    """
+    keys = list(keys)
+    index = load_index(reference_file)
+    if index is None:
+        return read_reference(reference_file, keys, bbox)
+    keys = np.array(keys, dtype=np.int64).reshape(-1, 4)
+    cellids = index["index_cellid"]
+    starts = np.searchsorted(cellids, keys[:, 3], side="left")
+    stops = np.searchsorted(cellids, keys[:, 3], side="right")
+
+    offsets = []
+    for key, start, stop in zip(keys, starts, stops):
+        for i in range(start, stop):
+            if index["index_mcc"][i] == key[0] and index["index_mnc"][i] == key[1] and index["index_lac"][i] == key[2]:
+                offsets.append(int(index["index_offset"][i]))
+
+    matches = []
+    # Read in file order, so results match those of read_reference
+    with open(reference_file, "rb") as f:
+        for offset in sorted(offsets):
+            f.seek(offset)
+            row = next(csv.reader([f.readline().decode()]))
+            if bbox is None or in_bbox(row, bbox):
+                matches.append(row)
+    return matches
+
+def load_reference(reference_file, keys, bbox=None, use_index=True):
+    if use_index:
+        return lookup_reference(reference_file, keys, bbox)
+    return read_reference(reference_file, keys, bbox)
@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+import numpy as np
+from multiprocessing import shared_memory
+import matplotlib
+import matplotlib.cm
+import matplotlib.image
+import matplotlib.ticker as ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+import walksignal.data as data
+import walksignal.equations as equations
+import walksignal.towers as towers
+import walksignal.utils as utils
+
+# Model curves drawn on every path loss plot, as in plottools.plot_towerdata
+MODEL_CURVES = [
+    ("2d", 0.2, 0.5, "blue", "-"),
+    ("2d", 0.5, 0.5, "blue", "--"),
+    ("2d", 0.5, 0.2, "blue", "-."),
+    ("2d", 0.2, 0.2, "blue", ":"),
+    ("3d", 0.2, 0.5, "red", "-"),
+    ("3d", 0.5, 0.5, "red", "--"),
+    ("3d", 0.5, 0.2, "red", "-."),
+    ("3d", 0.2, 0.2, "red", ":"),
+]
+
+def get_cmap(name):
+    # matplotlib.cm.get_cmap was removed in matplotlib 3.9
+    if hasattr(matplotlib, "colormaps"):
+        return matplotlib.colormaps[name]
+    return matplotlib.cm.get_cmap(name)
+
+class TowerFigures:
+    """Map and path loss figures that are drawn once and reused for every
+    tower, by swapping in each tower's data before saving."""
+    def __init__(self, plot_map, bbox, cmap="gist_heat"):
+        self.map_fig = Figure(figsize=(8, 6))
+        FigureCanvasAgg(self.map_fig)
+        self.map_ax = self.map_fig.add_subplot(111)
+        self.map_ax.imshow(plot_map, zorder=0, extent=bbox, aspect="equal")
+        self.power_scatter = self.map_ax.scatter([], [], zorder=1, alpha=1.0, s=20, c=[], cmap=get_cmap(cmap))
+        self.power_scatter.set_clim(-120, -40)
+        self.tower_marker = self.map_ax.scatter([], [], zorder=1, alpha=1.0, s=20, color="blue")
+        self.map_ax.set_xlim(bbox[0], bbox[1])
+        self.map_ax.set_ylim(bbox[2], bbox[3])
+        self.map_ax.set_xlabel("Longitude")
+        self.map_ax.set_ylabel("Latitude", rotation=90)
+        fmtr = ticker.FormatStrFormatter('% 1.4f')
+        self.map_ax.xaxis.set_major_formatter(fmtr)
+        self.map_ax.yaxis.set_major_formatter(fmtr)
+        cax = make_axes_locatable(self.map_ax).append_axes("right", size="5%", pad=0.1)
+        self.cbar = self.map_fig.colorbar(self.power_scatter, cax=cax)
+        self.cbar.ax.set_ylabel("Signal Power (dBm)", rotation=270, labelpad=10)
+
+        self.pl_fig = Figure(figsize=(8, 6))
+        FigureCanvasAgg(self.pl_fig)
+        self.pl_ax = self.pl_fig.add_subplot(111)
+        self.pl_ax.set_xlabel("Distances (m)")
+        self.pl_ax.set_ylabel("Power (dBm)")
+        self.pl_ax.grid()
+        rwm_x = np.linspace(1, 350, 250)
+        for model, obs_dens, absorption, color, marker in MODEL_CURVES:
+            self.pl_ax.plot(rwm_x, equations.cached_rwm(model, obs_dens, absorption, rwm_x), linestyle=marker, color=color)
+        self.power_line, = self.pl_ax.plot([], [], 'o', color='black')
+
+    def render(self, tower_data, outdir, formats):
+        key, lon_series, lat_series, signal_power, distances, tower_lon, tower_lat = tower_data
+        name = "tower_{0}_{1}_{2}_{3}".format(*key)
+
+        self.power_scatter.set_offsets(np.column_stack([lon_series, lat_series]))
+        self.power_scatter.set_array(signal_power)
+        if len(signal_power):
+            self.power_scatter.set_clim(np.min(signal_power), np.max(signal_power))
+        self.tower_marker.set_offsets([[tower_lon, tower_lat]])
+        self.cbar.update_normal(self.power_scatter)
+        self.map_ax.set_title("Signal Power vs Position ({0})".format(" ".join(map(str, key))))
+
+        self.power_line.set_data(distances, signal_power)
+        self.pl_ax.relim()
+        self.pl_ax.autoscale_view()
+        self.pl_fig.suptitle("Power vs Distance ({0})".format(" ".join(map(str, key))))
+
+        paths = []
+        for fmt in formats:
+            for fig, suffix in ((self.map_fig, "map"), (self.pl_fig, "pathloss")):
+                path = os.path.join(outdir, "{0}_{1}.{2}".format(name, suffix, fmt))
+                fig.savefig(path)
+                paths.append(path)
+        return paths
+
+# Per-worker state, set up by _init_worker
+_figures = None
+_map_memory = None
+
+def _init_worker(map_name, map_shape, map_dtype, bbox):
+    global _figures, _map_memory
+    # Every worker maps the decoded image from shared memory rather than
+    # decoding map.png again
+    _map_memory = shared_memory.SharedMemory(name=map_name)
+    plot_map = np.ndarray(map_shape, dtype=map_dtype, buffer=_map_memory.buf)
+    _figures = TowerFigures(plot_map, bbox)
+
+def _render_tower(tower_data, outdir, formats):
+    return _figures.render(tower_data, outdir, formats)
+
+def tower_data(tower):
+    return ((tower.mcc, tower.mnc, tower.lac, tower.cellid), np.asarray(tower.lon_series), np.asarray(tower.lat_series),
+            np.asarray(tower.signal_power), np.asarray(tower.distances), tower.lon, tower.lat)
+
+def render_towers(tower_list, map_path, bbox_path, outdir, formats=("png",), processes=None):
+    """Save the map and path loss figures of every tower in tower_list.
+
+    Figures are rendered with the Agg backend, so no display is needed,
+    in a process pool that shares a single decoded copy of the map.
+    Returns the paths of the files written.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    plot_map = matplotlib.image.imread(map_path)
+    bbox = utils.get_bbox(bbox_path)[0]
+    jobs = [tower_data(tower) for tower in tower_list.tower_list]
+
+    if processes == 1:
+        figures = TowerFigures(plot_map, bbox)
+        return [path for job in jobs for path in figures.render(job, outdir, formats)]
+
+    map_memory = shared_memory.SharedMemory(create=True, size=max(plot_map.nbytes, 1))
+    try:
+        np.ndarray(plot_map.shape, dtype=plot_map.dtype, buffer=map_memory.buf)[...] = plot_map
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(map_memory.name, plot_map.shape, plot_map.dtype.str, bbox)) as pool:
+            results = pool.starmap(_render_tower, [(job, outdir, formats) for job in jobs])
+    finally:
+        map_memory.close()
+        map_memory.unlink()
+    return [path for paths in results for path in paths]
+
+def render_dataset(datafile, reference_file, outdir, formats=("png",), processes=None):
+    dataset = data.load_dataset(datafile)
+    # e.g. a StoreDataSet spanning more than one area
+    if dataset.map_path is None:
+        raise ValueError("{0} has no single map, select one area".format(dataset.dataset_name))
+    tower_list = towers.TowerList(dataset, reference_file)
+    return render_towers(tower_list, dataset.map_path, dataset.bbox_path, outdir, formats, processes)
@@ -0,0 +1,78 @@
+import numpy as np
+import utm
+from scipy.spatial import cKDTree
+import walksignal.reference as reference
+
+class TowerIndex:
+    """A KD-tree over tower positions, projected to UTM coordinates.
+
+    Every position is projected into the UTM zone of the median tower,
+    which keeps distances within a fraction of a percent of the geodesic
+    ones over the size of a city.
+    """
+    def __init__(self, lats, lons, ranges, keys=None):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.ranges = np.asarray(ranges, dtype=float)
+        self.keys = keys
+        self.zone_number = utm.latlon_to_zone_number(np.median(self.lats), np.median(self.lons))
+        self.northern = bool(np.median(self.lats) >= 0)
+        self.xy = self.project(self.lats, self.lons)
+        self.tree = cKDTree(self.xy)
+
+    @classmethod
+    def from_reference(cls, reference_file, bbox=None):
+        rows = reference.read_reference(reference_file, bbox=bbox)
+        lats = [float(row[reference.LAT]) for row in rows]
+        lons = [float(row[reference.LON]) for row in rows]
+        ranges = [float(row[reference.RANGE]) for row in rows]
+        keys = [reference.row_key(row) for row in rows]
+        return cls(lats, lons, ranges, keys)
+
+    @classmethod
+    def from_tower_list(cls, tower_list):
+        towers = tower_list.tower_list
+        keys = [(tower.mcc, tower.mnc, tower.lac, tower.cellid) for tower in towers]
+        return cls([tower.lat for tower in towers], [tower.lon for tower in towers], [tower.range for tower in towers], keys)
+
+    def project(self, lats, lons):
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if lats.size == 0:
+            return np.empty((0, 2))
+        x, y, zn, zl = utm.from_latlon(lats, lons, force_zone_number=self.zone_number, force_northern=self.northern)
+        return np.column_stack([np.ravel(x), np.ravel(y)])
+
+    def nearest(self, lats, lons, k=1):
+        """Return the distances in m and indices of the k nearest towers
+        to every point, as arrays of shape (points, k)."""
+        distances, indices = self.tree.query(self.project(lats, lons), k=k)
+        return distances.reshape(-1, k), indices.reshape(-1, k)
+
+    def covering(self, lats, lons):
+        """Return every (point, tower) pair where the point is within the
+        tower's range, as arrays of point indices, tower indices and
+        distances in m sorted by point."""
+        points = cKDTree(self.project(lats, lons))
+        pairs = self.tree.sparse_distance_matrix(points, self.ranges.max(initial=0), output_type="ndarray")
+        pairs = pairs[pairs["v"] <= self.ranges[pairs["i"]]]
+        pairs = pairs[np.lexsort((pairs["v"], pairs["j"]))]
+        return pairs["j"], pairs["i"], pairs["v"]
+
+    def serving(self, dataset):
+        """Match every sample in dataset to the tower it was recorded from.
+
+        Returns the index of the sample's tower (or -1 if it is not in the
+        index), its distance in m and whether the sample lies within the
+        tower's range.
+        """
+        lookup = {key: i for i, key in enumerate(self.keys)}
+        samples = zip(dataset.mcc.tolist(), dataset.mnc.tolist(), dataset.lac.tolist(), dataset.cellid.tolist())
+        indices = np.array([lookup.get(key, -1) for key in samples], dtype=np.int64)
+        found = indices >= 0
+        distances = np.full(len(indices), np.nan)
+        sample_xy = self.project(dataset.lat[found], dataset.lon[found])
+        distances[found] = np.hypot(*(sample_xy - self.xy[indices[found]]).T)
+        in_range = np.zeros(len(indices), dtype=bool)
+        in_range[found] = distances[found] <= self.ranges[indices[found]]
+        return indices, distances, in_range
@@ -0,0 +1,205 @@
+"""A store of measurements from several campaigns, partitioned by area and day.
+
+Each area (a directory of exports with its map.png and bbox.txt, such as
+data/uottawa) is ingested into <store>/<area>/<date>/, one .npy file per
+DataSet column for each UTC day of measurements. catalog.json lists the
+partitions along with the minimum and maximum of their time, lat, lon and
+cellid columns, so that queries only open the partitions that can match.
+"""
+import calendar
+import datetime
+import glob
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import walksignal.data as data
+import walksignal.groom as groom
+
+CATALOG = "catalog.json"
+
+# Bump this whenever the layout of the store changes
+STORE_VERSION = 1
+
+# Columns with min/max statistics in the catalog
+STATS_COLUMNS = ["time_range", "lat", "lon", "cellid"]
+
+DAY_MS = 86400 * 1000
+
+def date_ms(date):
+    """Return the time in ms of midnight UTC at the start of date.
+
+    date is a datetime.date or a "YYYY-MM-DD" string.
+    """
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    return calendar.timegm(date.timetuple()) * 1000
+
+def load_column(path, name):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+def ms_date(ms):
+    return datetime.datetime.fromtimestamp(ms / 1000, tz=datetime.timezone.utc).strftime("%Y-%m-%d")
+
+class Store:
+    def __init__(self, path):
+        self.path = path
+        self.catalog_file = os.path.join(path, CATALOG)
+        if os.path.exists(self.catalog_file):
+            with open(self.catalog_file) as f:
+                self.catalog = json.load(f)
+            if self.catalog.get("version") != STORE_VERSION:
+                raise ValueError("{0} was written by a different version of walksignal".format(path))
+        else:
+            self.catalog = {"version": STORE_VERSION, "areas": {}, "partitions": []}
+
+    def save(self):
+        # Replace the catalog in one step, so readers never see half of it
+        os.makedirs(self.path, exist_ok=True)
+        handle, path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(handle, "w") as f:
+            json.dump(self.catalog, f, indent=1)
+        os.replace(path, self.catalog_file)
+
+    @property
+    def areas(self):
+        return sorted(self.catalog["areas"])
+
+    def map_path(self, area):
+        return os.path.join(self.path, area, "map.png")
+
+    def bbox_path(self, area):
+        return os.path.join(self.path, area, "bbox.txt")
+
+    def ingest(self, directory, area=None, processes=None):
+        """Add the exports in directory to the store as area.
+
+        area defaults to the name of the directory. Every .csv file is
+        ingested except combined_data*.csv, the output of groom_data.
+        Rows are pruned and deduplicated as by groom_data, sorting the
+        files in a pool of processes, and any partitions already in the
+        store for area are replaced. Returns the number of rows ingested.
+        """
+        directory = os.path.abspath(directory)
+        area = area or os.path.basename(directory)
+        # combined_data.csv repeats the rows of the exports it was made from
+        filenames = sorted(f for f in glob.glob(os.path.join(directory, "*.csv")) if not os.path.basename(f).startswith("combined_data"))
+        if not filenames:
+            raise ValueError("No exports in {0}".format(directory))
+
+        area_path = os.path.join(self.path, area)
+        os.makedirs(area_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=area_path) as work:
+            combined = os.path.join(work, "combined.csv")
+            groom.groom_files(filenames, combined, sort=True, processes=processes, use_cache=False)
+            columns = data.parse_columns(combined) if os.path.getsize(combined) else None
+
+        for name in ("map.png", "bbox.txt"):
+            if os.path.exists(os.path.join(directory, name)):
+                shutil.copyfile(os.path.join(directory, name), os.path.join(area_path, name))
+        for partition in self.catalog["partitions"]:
+            if partition["area"] == area:
+                shutil.rmtree(os.path.join(self.path, partition["path"]), ignore_errors=True)
+        self.catalog["partitions"] = [p for p in self.catalog["partitions"] if p["area"] != area]
+        self.catalog["areas"][area] = {"sources": [os.path.basename(f) for f in filenames]}
+
+        rows = 0
+        if columns is not None:
+            days = columns["time_range"] // DAY_MS
+            for day in np.unique(days):
+                rows_in_day = days == day
+                date = ms_date(day * DAY_MS)
+                path = os.path.join(area, date)
+                os.makedirs(os.path.join(self.path, path), exist_ok=True)
+                for name, column in columns.items():
+                    np.save(os.path.join(self.path, path, name + ".npy"), column[rows_in_day], allow_pickle=False)
+                stats = {name: [columns[name][rows_in_day].min().item(), columns[name][rows_in_day].max().item()] for name in STATS_COLUMNS}
+                self.catalog["partitions"].append({"area": area, "date": date, "path": path, "rows": int(rows_in_day.sum()), "stats": stats})
+            rows = len(columns["time_range"])
+        self.save()
+        return rows
+
+    def partitions(self, area=None, cellid=None, start=None, end=None, bbox=None):
+        """Return the catalog entries of the partitions that could hold
+        rows matching the query. The arguments are as for query()."""
+        start_ms = date_ms(start) if start is not None else -np.inf
+        end_ms = date_ms(end) + DAY_MS if end is not None else np.inf
+        cellids = None if cellid is None else np.atleast_1d(cellid)
+        matches = []
+        for partition in self.catalog["partitions"]:
+            stats = partition["stats"]
+            if area is not None and partition["area"] != area:
+                continue
+            if stats["time_range"][1] < start_ms or stats["time_range"][0] >= end_ms:
+                continue
+            if bbox is not None:
+                lon_min, lon_max, lat_min, lat_max = bbox
+                if stats["lon"][1] < lon_min or stats["lon"][0] > lon_max or stats["lat"][1] < lat_min or stats["lat"][0] > lat_max:
+                    continue
+            if cellids is not None and not np.any((cellids >= stats["cellid"][0]) & (cellids <= stats["cellid"][1])):
+                continue
+            matches.append(partition)
+        return sorted(matches, key=lambda partition: (partition["area"], partition["date"]))
+
+    def query(self, columns=None, area=None, cellid=None, start=None, end=None, bbox=None):
+        """Return a dict of the named columns for the rows matching a query.
+
+        columns defaults to every DataSet column. Rows can be selected by
+        area, by cellid (a single id or a list), by the dates start and end
+        (inclusive "YYYY-MM-DD" strings or datetime.dates, in UTC), and by
+        bbox, a (lon_min, lon_max, lat_min, lat_max) tuple as in bbox.txt.
+        Partitions whose statistics rule out a match are never opened, and
+        only the columns that are needed are read from the rest. Rows are
+        ordered by area and then time.
+        """
+        columns = columns or data.DataSet.COLUMNS
+        start_ms = date_ms(start) if start is not None else None
+        end_ms = date_ms(end) + DAY_MS if end is not None else None
+        dtypes = {name: np.dtype(dtype) for column, name, dtype in data.SCHEMA}
+        parts = {name: [] for name in columns}
+        for partition in self.partitions(area, cellid, start, end, bbox):
+            path = os.path.join(self.path, partition["path"])
+            keep = np.ones(partition["rows"], dtype=bool)
+            if start_ms is not None:
+                keep &= load_column(path, "time_range") >= start_ms
+            if end_ms is not None:
+                keep &= load_column(path, "time_range") < end_ms
+            if cellid is not None:
+                keep &= np.isin(load_column(path, "cellid"), cellid)
+            if bbox is not None:
+                lon_min, lon_max, lat_min, lat_max = bbox
+                lon = load_column(path, "lon")
+                lat = load_column(path, "lat")
+                keep &= (lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max)
+            rows = np.flatnonzero(keep)
+            for name in columns:
+                parts[name].append(load_column(path, name)[rows])
+        return {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=dtypes[name]) for name in columns}
+
+class StoreDataSet(data.DataSet):
+    """A DataSet of the rows of a store matching a query.
+
+    The arguments after store are as for Store.query(). The map and bbox
+    are those of the area the rows come from, and are None if they come
+    from more than one area.
+    """
+    def __init__(self, store, area=None, cellid=None, start=None, end=None, bbox=None):
+        if not isinstance(store, Store):
+            store = Store(store)
+        self.store = store
+        areas = sorted({partition["area"] for partition in store.partitions(area, cellid, start, end, bbox)})
+        columns = store.query(self.COLUMNS, area, cellid, start, end, bbox)
+        if not len(columns["time_range"]):
+            raise ValueError("No measurements in {0} match the query".format(store.path))
+        self.data_file = store.path
+        self.data_path = store.path
+        if len(areas) == 1:
+            self.dataset_name = areas[0]
+            self.map_path = store.map_path(areas[0])
+            self.bbox_path = store.bbox_path(areas[0])
+        else:
+            self.dataset_name = ", ".join(areas)
+            self.map_path = None
+            self.bbox_path = None
+        self.set_columns(columns)
@@ -1,10 +1,24 @@
 #!/usr/bin/python3 
 import csv
 import sys
+from collections import namedtuple
 import numpy as np
+import walksignal.data as data
+import walksignal.profiling as profiling
+import walksignal.reference as reference
 import walksignal.utils as utils
 
+# Summary of a tower's signal power against distance. Each field has one
+# entry per non-empty distance bin: the bin's centre, the mean power, the
+# low and high percentiles of power, and the number of samples
+PowerProfile = namedtuple("PowerProfile", ["distance", "mean", "low", "high", "samples"])
+
 class Tower:
+    # Towers and their data points are lightweight views: every per-point
+    # series lives in the TowerList's columns, and a tower only holds
+    # slices of them
+    __slots__ = ("mcc", "mnc", "lac", "cellid", "lat", "lon", "range", "samples", "signal_type", "columns", "distances", "buffers")
+
     def __init__(self, signal_type, mcc, mnc, lac, cellid, lon, lat, tower_range, samples):
         self.mcc = mcc
         self.mnc = mnc
@@ -15,93 +29,246 @@ class Tower:
         self.range = tower_range
         self.samples = samples
         self.signal_type = signal_type
-        self.data_points = []
-        self.distances = []
-        self.signal_power = []
+        self.columns = {name: np.empty(0, dtype) for column, name, dtype in data.SCHEMA}
+        self.distances = np.array([])
+        self.buffers = None
+
+    def extend(self, columns, distances):
+        # The first time a tower grows, its slices are copied into growable
+        # buffers of its own, which later rows are appended to in place
+        if self.buffers is None:
+            self.buffers = {name: data.ColumnBuffer(column) for name, column in self.columns.items()}
+            self.buffers["distances"] = data.ColumnBuffer(self.distances)
+        for name, column in columns.items():
+            self.buffers[name].append(column)
+        self.buffers["distances"].append(distances)
+        self.columns = {name: self.buffers[name].view() for name in self.columns}
+        self.distances = self.buffers["distances"].view()
+
+    @property
+    def lat_series(self):
+        return self.columns["lat"]
+
+    @property
+    def lon_series(self):
+        return self.columns["lon"]
+
+    @property
+    def signal_power(self):
+        return self.columns["signal_range"]
+
+    def power_profile(self, bins=50, percentiles=(10, 90)):
+        """Bin signal power by distance into a PowerProfile.
+
+        The bins are of equal width between the smallest and largest
+        distances, and empty bins are left out.
+        """
+        distances = np.asarray(self.distances, dtype=float)
+        power = np.asarray(self.signal_power, dtype=float)
+        if not len(distances):
+            return PowerProfile(*(np.array([]) for field in PowerProfile._fields))
+        edges = np.linspace(distances.min(), distances.max(), bins + 1)
+        cells = np.clip(np.searchsorted(edges, distances, side="right") - 1, 0, bins - 1)
+
+        # Sort by bin and then power, so each bin's powers are a sorted run
+        # that the percentiles can be interpolated from directly
+        order = np.lexsort((power, cells))
+        cells = cells[order]
+        power = power[order]
+        counts = np.bincount(cells, minlength=bins)
+        used = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)])[used]
+        counts = counts[used]
+        mean = np.add.reduceat(power, starts) / counts
+        bands = []
+        for percentile in percentiles:
+            position = starts + percentile / 100 * (counts - 1)
+            below = np.floor(position).astype(np.int64)
+            above = np.minimum(below + 1, starts + counts - 1)
+            bands.append(power[below] + (position - below) * (power[above] - power[below]))
+        centres = (edges[:-1] + edges[1:])[used] / 2
+        return PowerProfile(centres, mean, bands[0], bands[1], counts)
+
+    @property
+    def data_points(self):
+        return [TowerDataPoint(self, index) for index in range(len(self.distances))]
 
 class TowerList:
-    def __init__(self, data, reference_file):
+    def __init__(self, dataset, reference_file, bbox=None, use_index=True, progress=None):
         self.tower_id_list = []
         self.tower_list = []
         self.cellid_list = []
-        self.data = np.array(data)
+        self.tower_index = {}
+        self.dataset = dataset
+        self.reference_file = reference_file
+        self.bbox = bbox
+        self.use_index = use_index
+        self.columns = {}
+        self.distances = np.array([])
         self.lats = np.array([])
         self.lons = np.array([])
-        
-        self.reference_data = utils.read_csv(reference_file)
+        # Called with the name of each stage as it starts. It may raise to
+        # abandon the build, e.g. when a GUI load is cancelled
+        self.progress = progress or (lambda stage: None)
 
         # Fill tower_id_list with tuples of mcc, mnc, lac, cellid
-        self.get_tower_ids()
+        with profiling.span("towers.get_tower_ids", rows=len(dataset.mcc)) as span:
+            self.get_tower_ids()
+            span.set(towers=len(self.tower_id_list))
+
+        # Only keep the reference rows for detected towers (and optionally
+        # only those inside bbox), rather than the whole reference file
+        self.progress("reference")
+        with profiling.span("towers.load_reference", file=reference_file, use_index=use_index) as span:
+            self.reference_data = reference.load_reference(reference_file, self.tower_id_list, bbox, use_index)
+            span.set(rows=len(self.reference_data))
 
-        # Add detected towers to the tower_list by comparing mcc, mnc,
-        # lac, cellid with the reference file
-        self.get_towers()
+        # Add detected towers to the tower_list from the matching reference
+        # rows
+        self.progress("towers")
+        with profiling.span("towers.get_towers") as span:
+            self.get_towers()
+            span.set(towers=len(self.tower_list))
 
-        # Add all relevant datapoints to each tower's data_points list
-        self.get_tower_data_points()
-        self.get_distances()
-        self.get_power()
+        # Group the dataset rows by tower and give each tower its slice
+        self.progress("data points")
+        with profiling.span("towers.get_tower_data_points") as span:
+            self.get_tower_data_points()
+            span.set(rows=len(self.rows))
+        self.progress("distances")
+        with profiling.span("towers.get_distances", rows=len(self.rows)):
+            self.get_distances()
         self.get_tower_lats()
         self.get_tower_lons()
+        self.row_count = len(dataset.mcc)
 
-    def get_tower_ids(self):
-        for row in self.data:
-            if row[3] not in self.cellid_list:
-                self.cellid_list.append(row[3])
-                self.tower_id_list.append((row[0], row[1], row[2], row[3]))
-
-    def get_towers(self):
-        for row in self.reference_data:
-            for entry in self.tower_id_list:
-                if ((row[1] == entry[0]) and (row[2] == entry[1]) and (row[3] == entry[2]) and (row[4] == entry[3])):
-                    self.tower_list.append(Tower(row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[8], row[9]))
+    def update(self):
+        """Add the dataset rows appended since the last build or update.
+
+        Only the reference rows of towers that weren't seen before are
+        looked up, and only the new rows' distances are computed. Returns
+        the towers that gained data points. self.rows, self.columns and
+        self.distances keep describing the initial build only; each
+        tower's columns and distances cover every row.
+        """
+        ds = self.dataset
+        start, stop = self.row_count, len(ds.mcc)
+        if start == stop:
+            return []
+        with profiling.span("towers.update", rows=stop - start) as span:
+            new_ids = self.get_tower_ids(start)
+            if new_ids:
+                rows = reference.load_reference(self.reference_file, new_ids, self.bbox, self.use_index)
+                self.reference_data.extend(rows)
+                self.get_towers(rows)
+                self.get_tower_lats()
+                self.get_tower_lons()
+
+            keys = zip(ds.mcc[start:].tolist(), ds.mnc[start:].tolist(), ds.lac[start:].tolist(), ds.cellid[start:].tolist())
+            row_towers = np.fromiter((self.tower_positions.get(key, -1) for key in keys), dtype=np.int64, count=stop - start)
+            rows = np.flatnonzero(row_towers >= 0)
+            rows = rows[np.argsort(row_towers[rows], kind="stable")]
+            row_towers = row_towers[rows]
+            columns = {name: np.asarray(getattr(ds, name))[start:][rows] for name in data.DataSet.COLUMNS}
+            distances = utils.get_distances(self.lats[row_towers], self.lons[row_towers], columns["lat"], columns["lon"]) * 1000
+
+            updated = []
+            positions, bounds = np.unique(row_towers, return_index=True)
+            for position, begin, end in zip(positions, bounds, np.append(bounds[1:], len(rows))):
+                tower = self.tower_list[position]
+                tower.extend({name: column[begin:end] for name, column in columns.items()}, distances[begin:end])
+                updated.append(tower)
+            self.row_count = stop
+            span.set(towers=len(updated), new_towers=len(new_ids))
+        return updated
+
+    def get_tower_ids(self, start=0):
+        # Add the keys first seen at or after row start, and return them
+        if start == 0:
+            self.seen_ids = set()
+        ds = self.dataset
+        new_ids = []
+        for key in zip(ds.mcc[start:].tolist(), ds.mnc[start:].tolist(), ds.lac[start:].tolist(), ds.cellid[start:].tolist()):
+            if key not in self.seen_ids:
+                self.seen_ids.add(key)
+                self.cellid_list.append(key[3])
+                self.tower_id_list.append(key)
+                new_ids.append(key)
+        return new_ids
+
+    def get_towers(self, reference_rows=None):
+        # Reference files can list the same cell more than once, so only the
+        # first matching row for each key becomes a Tower
+        if reference_rows is None:
+            self.tower_positions = {}
+            reference_rows = self.reference_data
+        for row in reference_rows:
+            key = reference.row_key(row)
+            if key not in self.tower_index:
+                tower = Tower(row[0], key[0], key[1], key[2], key[3], float(row[6]), float(row[7]), int(row[8]), int(row[9]))
+                self.tower_index[key] = tower
+                self.tower_positions[key] = len(self.tower_list)
+                self.tower_list.append(tower)
         
     def get_tower_data_points(self):
-        for tower in self.tower_list:
-            for row in self.data:
-                if ((tower.mcc == row[0]) and (tower.mnc == row[1]) and (tower.lac == row[2]) and (tower.cellid == row[3])):
-                    tower.data_points.append(TowerDataPoint(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[14], row[15]))
-    
-    def get_distances(self):
-        for tower in self.tower_list:
-            for datapoint in tower.data_points:
-                tower.distances.append(utils.get_distance(tower.lat, tower.lon, datapoint.lat, datapoint.lon) * 1000)
+        # Find the tower of every row, then sort the rows by tower so that
+        # each tower's data points are a contiguous slice of self.columns
+        ds = self.dataset
+        keys = zip(ds.mcc.tolist(), ds.mnc.tolist(), ds.lac.tolist(), ds.cellid.tolist())
+        row_towers = np.fromiter((self.tower_positions.get(key, -1) for key in keys), dtype=np.int64, count=len(ds.mcc))
+        self.rows = np.flatnonzero(row_towers >= 0)
+        self.rows = self.rows[np.argsort(row_towers[self.rows], kind="stable")]
+        self.row_towers = row_towers[self.rows]
+        self.columns = {name: np.asarray(getattr(ds, name))[self.rows] for name in data.DataSet.COLUMNS}
 
-    def get_power(self):
-        for tower in self.tower_list:
-            for datapoint in tower.data_points:
-                tower.signal_power.append(float(datapoint.signal))
+        bounds = np.searchsorted(self.row_towers, np.arange(len(self.tower_list) + 1))
+        for tower, start, stop in zip(self.tower_list, bounds[:-1], bounds[1:]):
+            tower.columns = {name: column[start:stop] for name, column in self.columns.items()}
+    
+    def get_distances(self, method="vincenty"):
+        # Compute every distance in one call, then hand out slices
+        tower_lats = np.array([tower.lat for tower in self.tower_list], dtype=float)
+        tower_lons = np.array([tower.lon for tower in self.tower_list], dtype=float)
+        self.distances = utils.get_distances(tower_lats[self.row_towers], tower_lons[self.row_towers], self.columns["lat"], self.columns["lon"], method) * 1000
+        bounds = np.searchsorted(self.row_towers, np.arange(len(self.tower_list) + 1))
+        for tower, start, stop in zip(self.tower_list, bounds[:-1], bounds[1:]):
+            tower.distances = self.distances[start:stop]
 
     def get_tower_lats(self):
-        for tower in self.tower_list:
-            self.lats = np.concatenate([self.lats, [float(tower.lat)]])
+        self.lats = np.array([tower.lat for tower in self.tower_list], dtype=float)
 
     def get_tower_lons(self):
-        for tower in self.tower_list:
-            self.lons = np.concatenate([self.lons, [float(tower.lon)]])
+        self.lons = np.array([tower.lon for tower in self.tower_list], dtype=float)
 
     def get_tower_data(self, mcc, mnc, lac, cellid):
-        for tower in self.tower_list:
-            if ((tower.mcc == mcc) and (tower.mnc == mnc) and (tower.lac == lac) and (tower.cellid == cellid)):
-                return tower
+        return self.tower_index.get((int(mcc), int(mnc), int(lac), int(cellid)))
+
 
+# Names of TowerDataPoint attributes that differ from the DataSet columns
+# they are read from
+DATA_POINT_COLUMNS = {"signal": "signal_range", "measured_at": "time_range", "speed": "speed_values", "pci": "pcis"}
 
 class TowerDataPoint:
-	def __init__(self, mcc, mnc, lac, cellid, lat, lon, signal, measured_at, rating, speed, direction, access_type, timing_advance, tac, pci):
-	  self.mcc = mcc
-	  self.mnc = mnc
-	  self.lac = lac
-	  self.cellid = cellid
-	  self.lat = lat
-	  self.lon = lon
-	  self.signal = signal
-	  self.measured_at = measured_at
-	  self.rating = rating
-	  self.speed = speed
-	  self.direction = direction
-	  self.access_type = access_type
-	  self.timing_advance = timing_advance
-	  self.tac = tac
-	  self.pci = pci
-	  self.numeric_id = str(self.mcc) + str(self.mnc) + str(self.lac) + str(self.cellid)
+    """A view of one row of a Tower's columns.
+
+    Attributes are the OpenCellID export fields (mcc, mnc, lac, cellid,
+    lat, lon, signal, measured_at, rating, speed, direction, access_type,
+    timing_advance, tac, pci), read from the tower's columns on access.
+    """
+    __slots__ = ("tower", "index")
+
+    def __init__(self, tower, index):
+        self.tower = tower
+        self.index = index
+
+    def __getattr__(self, name):
+        column = self.tower.columns.get(DATA_POINT_COLUMNS.get(name, name))
+        if column is None:
+            raise AttributeError(name)
+        if name == "access_type":
+            return data.ACCESS_TYPES[column[self.index]]
+        return column[self.index]
 
+    @property
+    def numeric_id(self):
+        return str(self.mcc) + str(self.mnc) + str(self.lac) + str(self.cellid)
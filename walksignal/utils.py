@@ -1,7 +1,7 @@
 import csv
 import math
+import numpy as np
 import utm
-from geopy import distance
 
 def read_csv(data_file):
       with open(data_file) as csv_file:
@@ -9,6 +9,42 @@ def read_csv(data_file):
           csv_file.close()
       return data
 
+def read_typed_csv(data_file, schema, converters=None, default_header=None):
+    """Parse the columns named in schema from a CSV file.
+
+    schema is a list of (column, name, dtype) tuples, where column is the
+    name in the CSV header and name is the key of the returned array.
+    Columns not listed in schema are skipped without being stored, and
+    converters optionally maps a column name to a function that turns its
+    string values into dtype. Files without a header row (such as the
+    .pruned files written by groom_data) are read using default_header as
+    the column names.
+    """
+    with open(data_file, encoding="utf-8-sig") as csv_file:
+        header = read_header(csv_file.readline(), schema, default_header)
+        if header is default_header:
+            csv_file.seek(0)
+        return parse_typed_lines(csv_file, header, schema, converters)
+
+def read_header(line, schema, default_header=None):
+    # Return the column names in line if it is a header row, or
+    # default_header if it is a data row
+    header = next(csv.reader([line]), [])
+    return header if schema[0][0] in header else default_header
+
+def parse_typed_lines(lines, header, schema, converters=None):
+    """Parse the columns named in schema from an iterable of CSV lines.
+
+    header lists the names of every column in the lines, and schema and
+    converters are as for read_typed_csv.
+    """
+    converters = converters or {}
+    indices = [header.index(column) for column, name, dtype in schema]
+    records = np.loadtxt(lines, delimiter=",", usecols=indices, ndmin=1,
+                         dtype=[(name, dtype) for column, name, dtype in schema],
+                         converters={header.index(column): converter for column, converter in converters.items()})
+    return {name: np.ascontiguousarray(records[name]) for column, name, dtype in schema}
+
 def get_bbox(bbox_path):
       bbox = None
       with open(bbox_path) as f:
@@ -24,9 +60,9 @@ def convert_to_latlon(x, y, zn, zl):
     return lat, lon
 
 def advance_coordinates(x, y, speed, direction):
-    # north is 0, east is 90
-    x_advance = speed * -1 * math.cos(direction + math.pi/2)
-    y_advance = speed * math.sin(direction + math.pi/2)
+    # north is 0, east is 90. Works on scalars or arrays
+    x_advance = speed * -1 * np.cos(direction + math.pi/2)
+    y_advance = speed * np.sin(direction + math.pi/2)
     adj_x = x + x_advance
     adj_y = y + y_advance
 
@@ -38,10 +74,186 @@ def project_next_position(lat, lon, speed, direction):
     lat_proj, lon_proj = convert_to_latlon(adj_x, adj_y, zn, zl)
     return lat_proj, lon_proj
 
+def latlon_to_zone_numbers(lat, lon):
+    # Vectorized utm.latlon_to_zone_number, including the special zones
+    # for Norway and Svalbard
+    lat = np.asarray(lat, dtype=float)
+    lon = (np.asarray(lon, dtype=float) % 360 + 540) % 360 - 180
+    zones = ((lon + 180) / 6).astype(int) + 1
+    zones = np.where((56 <= lat) & (lat < 64) & (3 <= lon) & (lon < 12), 32, zones)
+    svalbard = (72 <= lat) & (lat <= 84) & (lon >= 0) & (lon < 42)
+    svalbard_zones = np.select([lon < 9, lon < 21, lon < 33], [31, 33, 35], 37)
+    return np.where(svalbard, svalbard_zones, zones)
+
+def project_next_positions(lat, lon, speed, direction):
+    """Vectorized project_next_position for arrays of samples.
+
+    Samples are converted to and from UTM in one call per (zone,
+    hemisphere) group, so a walk that crosses a zone boundary is still
+    projected correctly.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat_proj = np.empty_like(lat)
+    lon_proj = np.empty_like(lon)
+    zones = latlon_to_zone_numbers(lat, lon)
+    northern = lat >= 0
+    for zone, north in set(zip(zones.tolist(), northern.tolist())):
+        group = (zones == zone) & (northern == north)
+        x, y, zn, zl = utm.from_latlon(lat[group], lon[group], force_zone_number=zone, force_northern=north)
+        adj_x, adj_y = advance_coordinates(x, y, np.asarray(speed)[group], np.asarray(direction)[group])
+        lat_proj[group], lon_proj[group] = utm.to_latlon(adj_x, adj_y, zone, northern=north, strict=False)
+    return lat_proj, lon_proj
+
+def correct_positions(lat, lon, speed, direction, corr=1.01):
+    """Return copies of lat and lon with GPS jumps replaced by projections.
+
+    Each sample is projected forward using its speed and direction. If
+    the next recorded position moved further than the projection (by a
+    factor of corr) in latitude or longitude, that coordinate of the
+    sample is replaced by the projected one. The last sample is never
+    corrected.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    corrected_lat = lat.copy()
+    corrected_lon = lon.copy()
+    if len(lat) < 2:
+        return corrected_lat, corrected_lon
+
+    proj_lat, proj_lon = project_next_positions(lat[:-1], lon[:-1], np.asarray(speed)[:-1], np.asarray(direction)[:-1])
+    fix_lat = np.absolute(lat[:-1] - lat[1:]) > np.absolute(lat[:-1] - proj_lat) * corr
+    fix_lon = np.absolute(lon[:-1] - lon[1:]) > np.absolute(lon[:-1] - proj_lon) * corr
+    corrected_lat[:-1] = np.where(fix_lat, proj_lat, lat[:-1])
+    corrected_lon[:-1] = np.where(fix_lon, proj_lon, lon[:-1])
+
+    return corrected_lat, corrected_lon
+
 def get_distance(lat1, lon1, lat2, lon2):
+    # geopy is slow to import, and get_distances covers most uses
+    from geopy import distance
     earth_radius = 6373.0
     coords_one = (lat1, lon1)
     coords_two = (lat2, lon2)
 
     return distance.distance(coords_one, coords_two).km
 
+# WGS-84 ellipsoid, as used by geopy.distance.distance
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+MEAN_EARTH_RADIUS = 6371.0088
+
+def get_distances(lat1, lon1, lat2, lon2, method="vincenty"):
+    """Return the distances in km between two sets of coordinates.
+
+    The inputs are broadcast against each other, so a single tower
+    position can be compared with an array of sample positions in one
+    call. Available methods, with their worst-case error relative to
+    geopy.distance.distance for walks of a few km in size:
+
+    - "vincenty": Vincenty's inverse formula on the WGS-84 ellipsoid,
+      within 1 mm of geopy except for nearly antipodal points, which do
+      not occur in walk data
+    - "haversine": great circle on a sphere of mean radius, within 0.5%
+    - "equirectangular": flat projection about the mean latitude, within
+      0.5% up to a few tens of km and degrading beyond that
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (lat1, lon1, lat2, lon2)))
+    if method == "vincenty":
+        return _vincenty_distances(lat1, lon1, lat2, lon2)
+    elif method == "haversine":
+        return _haversine_distances(lat1, lon1, lat2, lon2)
+    elif method == "equirectangular":
+        return _equirectangular_distances(lat1, lon1, lat2, lon2)
+    raise ValueError("Unknown distance method {0}".format(method))
+
+def _haversine_distances(lat1, lon1, lat2, lon2):
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lon2 - lon1)
+    h = np.square(np.sin(dphi / 2)) + np.cos(phi1) * np.cos(phi2) * np.square(np.sin(dlambda / 2))
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def _equirectangular_distances(lat1, lon1, lat2, lon2):
+    x = np.radians(lon2 - lon1) * np.cos(np.radians(lat1 + lat2) / 2)
+    y = np.radians(lat2 - lat1)
+    return MEAN_EARTH_RADIUS * np.hypot(x, y)
+
+def _vincenty_distances(lat1, lon1, lat2, lon2, max_iterations=200, tolerance=1e-12):
+    f = WGS84_F
+    u1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    big_l = np.radians(lon2 - lon1)
+    lam = big_l.copy()
+
+    # Iterate every pair together, freezing each one once it converges
+    active = np.ones(lam.shape, dtype=bool)
+    for _ in range(max_iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - np.square(sin_alpha)
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+        c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+        lam_next = big_l + (1 - c) * f * sin_alpha * (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * np.square(cos_2sigma_m))))
+        converged = np.abs(lam_next - lam) <= tolerance
+        lam = np.where(active, lam_next, lam)
+        active &= ~converged
+        if not active.any():
+            break
+
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+    sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+    cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+    sigma = np.arctan2(sin_sigma, cos_sigma)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+        cos_sq_alpha = 1 - np.square(sin_alpha)
+        cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (cos_sigma * (-1 + 2 * np.square(cos_2sigma_m)) - big_b / 6 * cos_2sigma_m * (-3 + 4 * np.square(sin_sigma)) * (-3 + 4 * np.square(cos_2sigma_m))))
+
+    return WGS84_B * big_a * (sigma - delta_sigma)
+
+def bin_values(lon, lat, values, extent, shape, stat="mean"):
+    """Aggregate values over a grid of cells covering extent.
+
+    extent is (lon_min, lon_max, lat_min, lat_max), as in bbox.txt, and
+    shape is the number of (rows, columns) of the grid. stat is "mean",
+    "max" or "count". Returns an array of the given shape with the first
+    row at lat_min, and NaN in cells without any samples. Samples outside
+    extent are ignored.
+    """
+    rows, cols = shape
+    lon_min, lon_max, lat_min, lat_max = extent
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    col = np.floor((lon - lon_min) / (lon_max - lon_min) * cols).astype(np.int64)
+    row = np.floor((lat - lat_min) / (lat_max - lat_min) * rows).astype(np.int64)
+    # Samples on the upper edges belong to the last row and column
+    col[lon == lon_max] = cols - 1
+    row[lat == lat_max] = rows - 1
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+    cells = row[inside] * cols + col[inside]
+
+    counts = np.bincount(cells, minlength=rows * cols).astype(float)
+    if stat == "count":
+        grid = counts
+    elif stat == "mean":
+        grid = np.bincount(cells, weights=np.asarray(values, dtype=float)[inside], minlength=rows * cols)
+        grid = np.divide(grid, counts, out=np.zeros(rows * cols), where=counts > 0)
+    elif stat == "max":
+        grid = np.full(rows * cols, -np.inf)
+        np.maximum.at(grid, cells, np.asarray(values, dtype=float)[inside])
+    else:
+        raise ValueError("Unknown statistic {0}".format(stat))
+    grid[counts == 0] = np.nan
+    return grid.reshape(rows, cols)